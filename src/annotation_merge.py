@@ -0,0 +1,117 @@
+"""
+    Incremental merge of annotation updates (ClinVar classes, cBioPortal cancer types) into the variant table
+    An annotation TSV holds a variant_id column and one or more of ANNOTATION_COLUMNS. It is hash-joined on variant_id
+    (the VariantLookup index, see variant_lookup.py) and only the rows whose annotation differs are rewritten, in the
+    categorical codes of their column. The new table shares the memory of the other columns with the current one, and
+    the delta of the merge lists the changed columns, so that only the caches reading them are invalidated (see
+    dataset_reload.py).
+    Empty cells and the variants absent from the TSV keep their current annotation.
+
+    VHL_ANNOTATION_PATH=<tsv> merges the file at start-up, and again whenever it changes with VHL_DATA_RELOAD_INTERVAL.
+
+    Delta of an annotation file :  python annotation_merge.py <annotations.tsv> [path or url of the csv]
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from dataset_reload import DatasetReloader, RELOAD_INTERVAL
+from variant_lookup import VariantLookup
+
+ANNOTATION_PATH = os.environ.get('VHL_ANNOTATION_PATH')
+ANNOTATION_COLUMNS = ['clinvar_simple', 'Cancer_type_single']
+# number of the variant_ids not in the table listed in the delta of a merge
+UNMATCHED_SAMPLE_SIZE = 20
+
+
+def read_annotations(path):
+    """
+    Annotation TSV as strings, the last line of a duplicated variant_id winning.
+    Raise ValueError if it has no variant_id column or none of ANNOTATION_COLUMNS.
+    """
+    annotations = pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+    columns = [column for column in ANNOTATION_COLUMNS if column in annotations.columns]
+    if 'variant_id' not in annotations.columns or not columns:
+        raise ValueError('An annotation file needs a variant_id column and one of: ' + ', '.join(ANNOTATION_COLUMNS))
+    return annotations.drop_duplicates('variant_id', keep='last')[['variant_id'] + columns]
+
+
+def recode(categorical, rows, values):
+    """Copy of a pd.Categorical with values set at the row positions rows, the new categories appended"""
+    categories = categorical.categories.append(pd.Index(values).unique().difference(categorical.categories))
+    codes = categorical.codes.astype(np.int32)
+    codes[rows] = categories.get_indexer(values)
+    return pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(categories))
+
+
+def merge_annotations(df, annotations, lookup=None):
+    """
+    Merge the annotations (read_annotations) into the variant table (load_variant_table, categorical annotations)
+    @param lookup
+    VariantLookup of df, to reuse its variant_id hash index
+    @return
+    (new table, delta of the merge); the new table is df itself when no annotation changed. The delta holds the
+    number of annotated variant_ids not in the table and the first UNMATCHED_SAMPLE_SIZE of them.
+    """
+    rows = (lookup or VariantLookup(df)).rows('variant_ids', annotations['variant_id'].tolist())
+    found = rows >= 0
+    unmatched = annotations['variant_id'].to_numpy(dtype=object)[~found]
+    delta = {'annotations': len(annotations), 'unmatched_variants': len(unmatched),
+             'unmatched_sample': unmatched[:UNMATCHED_SAMPLE_SIZE].tolist(), 'changed_rows': {}, 'new_categories': {}}
+    merged = df
+    for column in annotations.columns[1:]:
+        values = annotations[column].to_numpy(dtype=object)[found]
+        target = rows[found][values != '']
+        values = values[values != '']
+        # NaN != value: a missing annotation is changed too
+        changed = np.asarray(df[column].iloc[target].astype(object)) != values
+        if not changed.any():
+            continue
+        if merged is df:
+            merged = df.copy(deep=False)
+        new_values = values[changed]
+        merged[column] = recode(df[column].array, target[changed], new_values)
+        delta['changed_rows'][column] = len(new_values)
+        delta['new_categories'][column] = list(pd.Index(new_values).unique().difference(df[column].cat.categories))
+    delta['changed_columns'] = sorted(delta['changed_rows'])
+    return merged, delta
+
+
+def describe_delta(delta):
+    lines = ['%d annotated variants, %d not in the table' % (delta['annotations'], delta['unmatched_variants'])]
+    if delta['unmatched_sample']:
+        more = delta['unmatched_variants'] - len(delta['unmatched_sample'])
+        lines.append('not in the table: ' + ', '.join(delta['unmatched_sample']) + (' and %d more' % more if more else ''))
+    for column in ANNOTATION_COLUMNS:
+        lines.append('%-20s %6d changed rows  new categories: %s' % (
+            column, delta['changed_rows'].get(column, 0), ', '.join(delta['new_categories'].get(column, [])) or '-'))
+    return '\n'.join(lines)
+
+
+class AnnotationReloader(DatasetReloader):
+    """
+    Merge the annotation file into the current table whenever it changes (see DatasetReloader)
+    @param lookup
+    function returning the VariantLookup of the current table
+    """
+
+    def __init__(self, path, swap, lookup, interval=RELOAD_INTERVAL):
+        super().__init__(path, read_annotations, swap, interval)
+        self.lookup = lookup
+
+    def update(self, current):
+        new, delta = merge_annotations(current(), self.load(self.path), self.lookup())
+        if delta['unmatched_variants']:
+            print('%s: %d variants not in the table: %s' % (self.path, delta['unmatched_variants'],
+                                                           ', '.join(delta['unmatched_sample'])), flush=True)
+        return new, set(delta['changed_columns']), {'delta': delta}
+
+
+if __name__ == '__main__':
+    from variant_table import load_variant_table
+
+    table_path = sys.argv[2] if len(sys.argv) > 2 else 'assets/input/vhl_preprocess_df.csv'
+    print(describe_delta(merge_annotations(load_variant_table(table_path), read_annotations(sys.argv[1]))[1]))
@@ -7,11 +7,33 @@
 
 # IMPORT ---------------------------------------------------------------
 
-from dash import Dash, dcc, html, Output, Input, dash_table
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from functools import lru_cache
+from flask import Response, request, abort, stream_with_context, send_file
+from dash import Dash, dcc, html, Output, Input, State, dash_table, ctx, no_update
 import dash_bootstrap_components as dbc
-import plotly.express as px
 import pandas as pd
-from protein_3d import create_style_3d
+import numpy as np
+from protein_3d import create_style_3d, reduce_model
+from figure_encoding import compact_figure, round_columns
+from variant_table import load_variant_table
+from variant_export import iter_csv, iter_parquet, EXPORT_FORMATS
+from callback_trace import install_callback_tracer
+from profiler import profiled
+from warmup import WarmupState, start_warmup, run_warmup, install_readiness_endpoint
+from dataset_reload import DatasetReloader, column_cache, invalidate_columns, ALL_COLUMNS
+from annotation_merge import AnnotationReloader, ANNOTATION_PATH, merge_annotations, read_annotations
+from variant_lookup import VariantLookup, iter_lookup_json, parse_lookup_request, LOOKUP_KEYS
+from vcf_annotation import VcfAnnotator, iter_upload_bytes, iter_lines
+from variant_index import VariantIndex, box_rows
+from structure_index import StructureIndex, VHL_RESIDUE_OFFSET, to_protein_positions
+from residue_scores import residue_filter_key, residue_filter_mask, aggregate_residue_scores, describe_residue_filter, \
+    residue_score_range, DEFAULT_RNA_THRESHOLD, DEFAULT_CONSEQUENCES
 import dash_bio as dashbio
 from dash_bio.utils import PdbParser
 from dash.development.base_component import Component, _explicitize_args
@@ -22,6 +44,9 @@ import dash_daq as daq
 app = Dash(__name__, external_stylesheets=[dbc.themes.DARKLY], suppress_callback_exceptions=True,
            meta_tags=[{'name': 'viewport', 'content': 'width=device-width, initial-scale=1.0'}])
 server = app.server
+install_callback_tracer(app)
+warmup_state = WarmupState()
+install_readiness_endpoint(server, warmup_state)
 
 # FONT & COLOR  ---------------------------------------------------------------
 font_list = ["Arial", "Balto", "Courier New", "Droid Sans", "Droid Serif", "Droid Sans Mono", "Gravitas One",
@@ -55,7 +80,7 @@ dict_tier_class_green_red = {"Neutral": 'rgb(143,153,62)', "Intermediate": "#d7d
 dict_tier_class_c_blind_friendly = {"Neutral": 'rgb(143,153,62)', "Intermediate": '#e7f7d5', 'LOF2': '#d091bb',
                                     'LOF1': 'rgb(80, 7, 120)'}
 CUSTOM_CAT_ORDER = ["Neutral", "Intermediate", 'LOF2', 'LOF1'] + ['Synonymous', 'Missense', "Intronic",
-                                                                  "3' UTR", "Splice site", "Missense",
+                                                                  "3' UTR", "Splice site",
                                                                   "Canonical splice", "Stop lost", "Stop gained"] + [
                        "NA", "Absent ", "Benign", "Likely benign", "Uncertain significance",
                        "Conflicting interpretations of pathogenicity", "Likely pathogenic", "Pathogenic"] + ["Absent",
@@ -69,6 +94,23 @@ CUSTOM_CAT_ORDER = ["Neutral", "Intermediate", 'LOF2', 'LOF1'] + ['Synonymous',
                                                                                                              "Pancreatic Neuroendocrine"]
 DICT_COL_REG = {**dict_cons_colors, **dict_clin_colors, **dict_cbio_color, **dict_tier_class_green_red}
 DICT_COL_BLIND = {**dict_cons_colors, **dict_clin_colors, **dict_cbio_color, **dict_tier_class_c_blind_friendly}
+# drawing order of the categories, the last ones are drawn on top
+CATEGORY_RANK = {category: rank for rank, category in enumerate(CUSTOM_CAT_ORDER)}
+# palettes of the annotations updated by annotation_merge.py, the categories they lack get EXTRA_CATEGORY_COLORS
+ANNOTATION_PALETTES = {'clinvar_simple': dict_clin_colors, 'Cancer_type_single': dict_cbio_color}
+EXTRA_CATEGORY_COLORS = ['#88CCEE', '#CC6677', '#DDCC77', '#117733', '#332288', '#AA4499', '#44AA99', '#999933']
+# function score colorscales of the substitution heatmap, from the function class colours (LOF1 to Neutral)
+HEATMAP_COLORSCALE_REG = ['rgb(147,39,44)', '#f3a66e', '#d7dc99', 'rgb(143,153,62)']
+HEATMAP_COLORSCALE_BLIND = ['rgb(80, 7, 120)', '#d091bb', '#e7f7d5', 'rgb(143,153,62)']
+# substitution heatmaps: view -> (row column, column column, row labels order, x-axis title, y-axis title)
+HEATMAP_VIEWS = {'protein': ('nAA', 'protPos', list('GAVLIMFWPSTCYNQDEKRH*'), 'Protein position', 'Amino acid'),
+                 'genomic': ('alt', 'hg38_pos', ['A', 'C', 'G', 'T'], 'Genomic position', 'Alternative base')}
+# 2D plot: above DENSITY_THRESHOLD variants the 'auto' mode draws a 2D histogram of DENSITY_BINS x DENSITY_BINS bins,
+# the variants of the bins holding at most DENSITY_SPARSE_COUNT variants (outliers) are still drawn as points
+DENSITY_THRESHOLD = int(os.environ.get('VHL_DENSITY_THRESHOLD', 20000))
+DENSITY_BINS = 80
+DENSITY_SPARSE_COUNT = 2
+DENSITY_COLORSCALE = ['rgb(66,62,58)', light_gray, yel]
 
 # glossary padding
 cell_style = {'padding-bottom': '20px', 'font-weight': 'bold', 'color': yel}  # more title type
@@ -91,6 +133,17 @@ hover_text = ["<b>%{customdata[0]}</b>",
               "SGE function score: %{customdata[4]:.2f}",
               "SGE function class: %{customdata[5]}"]
 
+# columns read by the cached functions, a new dataset only invalidates the caches of the columns that changed
+FILTER_RANGE_COLUMNS = ['function_score_final', 'rna_score']
+FILTER_THRESHOLD_COLUMNS = ['CADD.phred', 'REVEL', 'VARITY_R', 'max_spliceAI']
+FILTER_CATEGORY_COLUMNS = ['consequence', 'clinvar_simple', 'tier_class']
+FILTER_COLUMNS = FILTER_RANGE_COLUMNS + FILTER_THRESHOLD_COLUMNS + FILTER_CATEGORY_COLUMNS
+OVERVIEW_AXIS_COLUMNS = ['index', 'hg38_pos', 'function_score_final', 'alt_pos']
+COLOR_COLUMNS = ['clinvar_simple', 'consequence', 'tier_class', 'Cancer_type_single']
+LOOKUP_INDEX_COLUMNS = ['variant_id', 'cHGVS', 'hg38_pos', 'ref', 'alt']
+RESIDUE_FILTER_COLUMNS = ['protPos', 'rna_score', 'consequence', 'tier_class']
+FIGURE_COLUMNS = hover_columns + COLOR_COLUMNS + FILTER_COLUMNS + OVERVIEW_AXIS_COLUMNS + ['ref_pos']
+
 
 # FUNCTION & CLASS ----------------------------------------------------------------------------------------------------
 
@@ -122,13 +175,60 @@ class BooleanSwitch(Component):
         super(BooleanSwitch, self).__init__(**args)
 
 
-def color_bar_structure():
-    # Create a scatterplot with invisible points
-    fig_color_bar = px.scatter(
-        df, x="rna_score", y='rna_score',
-        color=df['average_fs_missense_at_aa_rna'],
-        color_continuous_scale=['#DE2A17', '#823B6F', '#38378E'],  # red to blue
-    )
+def category_traces(data, color_column, x_col, y_col, colors, marker):
+    """
+    Scatter of the variants coloured by the categories of color_column, as a single trace
+    The points are ordered by CUSTOM_CAT_ORDER (drawing order of the former one-trace-per-category figures) and carry
+    a category code mapped to its colour by a stepped colorscale. Each category present gets a legend-only proxy trace.
+    Variants of a category absent from CUSTOM_CAT_ORDER are not drawn.
+    """
+    ranks = np.asarray(data[color_column].map(CATEGORY_RANK), dtype=float)
+    kept = np.flatnonzero(~np.isnan(ranks))
+    rows = kept[np.argsort(ranks[kept], kind='stable')]
+    present = np.unique(ranks[rows]).astype(int)
+    categories = [CUSTOM_CAT_ORDER[rank] for rank in present]
+    codes = np.searchsorted(present, ranks[rows])
+    n = max(len(categories), 1)
+    colorscale = [[position, colors[category]] for i, category in enumerate(categories)
+                  for position in (i / n, (i + 1) / n)]
+
+    data = data.iloc[rows]
+    # the category is shown in the side box of the hover label, as the trace name used to be
+    customdata = round_columns(data[hover_columns] if color_column in hover_columns
+                               else data[hover_columns + [color_column]])
+    category_index = list(customdata.columns).index(color_column)
+    traces = [go.Scatter(
+        x=data[x_col], y=data[y_col], mode='markers', customdata=customdata, showlegend=False,
+        marker=dict(marker, color=codes, colorscale=colorscale or None, cmin=-0.5, cmax=n - 0.5, showscale=False),
+        hovertemplate="<br>".join(hover_text) + "<extra>%{customdata[" + str(category_index) + "]}</extra>")]
+    for category in categories:
+        traces.append(go.Scatter(x=[None], y=[None], mode='markers', name=category, hoverinfo='skip',
+                                 marker=dict(marker, color=colors[category])))
+    return traces
+
+
+def density_grid(x, y, bins=DENSITY_BINS, sparse_count=DENSITY_SPARSE_COUNT):
+    """
+    2D histogram of the points (x, y), points with a missing coordinate left out
+    @return
+    (counts indexed [x bin, y bin], x bin edges, y bin edges, positions of the points in bins of at most sparse_count
+    points)
+    """
+    valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    counts, x_edges, y_edges = np.histogram2d(x[valid], y[valid], bins=bins)
+    # bin of every point, the last edge belonging to the last bin as in np.histogram2d
+    x_bins = np.clip(np.searchsorted(x_edges, x[valid], side='right') - 1, 0, bins - 1)
+    y_bins = np.clip(np.searchsorted(y_edges, y[valid], side='right') - 1, 0, bins - 1)
+    return counts, x_edges, y_edges, valid[counts[x_bins, y_bins] <= sparse_count]
+
+
+def color_bar_structure(score_range):
+    # Create a scatterplot with two invisible points carrying the range of the residue scores
+    fig_color_bar = go.Figure(go.Scatter(
+        x=[0, 0], y=[0, 0], mode='markers', showlegend=False, hoverinfo='skip',
+        marker=dict(color=list(score_range), coloraxis='coloraxis')))
+    fig_color_bar.update_layout(coloraxis=dict(colorscale=['#DE2A17', '#823B6F', '#38378E'],  # red to blue
+                                               cmin=score_range[0], cmax=score_range[1]))
 
     # Hide the points by setting opacity to 0 and marker size to 0
     fig_color_bar.update_traces(
@@ -154,7 +254,7 @@ def color_bar_structure():
             borderwidth=2,
             bordercolor=yel,
             tickcolor=yel,
-            tickvals=[df['average_fs_missense_at_aa_rna'].max(), df['average_fs_missense_at_aa_rna'].min()],
+            tickvals=[score_range[1], score_range[0]],
             tickwidth=2,
             tickmode='array',
             ticks="outside",
@@ -162,7 +262,14 @@ def color_bar_structure():
             ticklabelposition='inside left'
         )
     )
-    return fig_color_bar
+    return compact_figure(fig_color_bar)
+
+
+def structure_title(residue_filter, statistic):
+    # e.g. 'Averaged function score of missense variants with RNA score ≥ -2 per residue mapped on VHL structure'
+    statistic_text = {'mean': 'Averaged', 'min': 'Minimum'}[statistic]
+    return statistic_text + ' function score of ' + describe_residue_filter(*residue_filter) + \
+        ' per residue mapped on VHL structure'
 
 
 def variant_first_search_dropdown(list_var, df):
@@ -187,67 +294,330 @@ def variant_first_search_dropdown(list_var, df):
     return list_all_var_key
 
 
-def get_structure_file(selected_pdb_file):
+# directory or URL of the structures (default: the PDB files of this repository on GitHub)
+STRUCTURE_DIR = os.environ.get('VHL_STRUCTURE_DIR', 'https://github.com/Chloe-Terwagne/vhl_dash_board/blob/main/src/'
+                                                    'assets/input/3d_structure/')
+
+
+def structure_file_name(selected_pdb_file):
     if selected_pdb_file == ['VHL_B_H_C']:
-        selected_pdb_file = '1LM8_vbch_isolated.pdb?raw=true'
-    else:
-        selected_pdb_file = '1LM8_vhl_isolated.pdb?raw=true'
+        return '1LM8_vbch_isolated.pdb'
+    return '1LM8_vhl_isolated.pdb'
+
 
-    parser = PdbParser('https://github.com/Chloe-Terwagne/vhl_dash_board/blob/main/src/assets/input/3d_structure/' + selected_pdb_file)    
-    parser.mol3d_data()
+@lru_cache(maxsize=None)
+def load_structure(pdb_file):
+    """
+    Parse a structure once per worker. The returned dict is shared between callbacks and must not be modified.
+    """
+    if '://' in STRUCTURE_DIR:
+        parser = PdbParser(STRUCTURE_DIR.rstrip('/') + '/' + pdb_file + '?raw=true')
+    else:
+        parser = PdbParser(os.path.join(STRUCTURE_DIR, pdb_file))
     return parser.mol3d_data()
 
 
-def print_var_score_for_selected_residue(df, aa_name):
+@lru_cache(maxsize=None)
+def get_structure_index(pdb_file):
+    # KD-trees of the atom coordinates, built once per structure
+    return StructureIndex(load_structure(pdb_file)['atoms'])
+
+
+def selection_key(variant_ids):
+    # hashable and order independent key of a variant selection
+    return tuple(sorted(variant_ids)) if variant_ids else ()
+
+
+@column_cache(['variant_id'], maxsize=256)
+def get_selection_rows(variant_ids):
+    """
+    Row positions in df of a selection_key, computed once per selection and shared by all the callbacks it triggers
+    """
+    rows = get_variant_lookup().rows('variant_ids', variant_ids)
+    return np.unique(rows[rows >= 0])
+
+
+@column_cache(LOOKUP_INDEX_COLUMNS, maxsize=None)
+def get_variant_lookup():
+    # hash indexes of df on variant_id, cHGVS and (hg38_pos, ref, alt), see variant_lookup.py
+    return VariantLookup(df)
+
+
+def overview_axes(at_scale, y_axis_nucleotide):
+    # columns of the x and y axes of the overview scatter
+    x_overv = 'hg38_pos' if at_scale else 'index'
+    y_axis = 'alt_pos' if y_axis_nucleotide == "Variants expanded by nucleotide type" else 'function_score_final'
+    return x_overv, y_axis
+
+
+@column_cache(FILTER_COLUMNS + OVERVIEW_AXIS_COLUMNS, maxsize=None)
+def get_variant_index():
+    # sorted indexes and category bitmaps of df, see variant_index.py
+    return VariantIndex(df)
+
+
+def get_sorted_index(column):
+    return get_variant_index().sorted_index(column)
+
+
+def overview_selection_key(selection):
+    """
+    Hashable key of the overview-selection store (see the clientside callback reducing selectedData), None when
+    nothing is selected: ('range', x column, x range, y column, y range) for a box, ('ids', variant ids...) otherwise
+    """
+    if not selection:
+        return None
+    if selection.get('range'):
+        x_col, y_col = overview_axes(selection.get('at_scale'), selection.get('display'))
+        return 'range', x_col, tuple(selection['range']['x']), y_col, tuple(selection['range']['y'])
+    return ('ids',) + selection_key(selection.get('variant_ids'))
+
+
+@column_cache(OVERVIEW_AXIS_COLUMNS + ['variant_id'], maxsize=256)
+def get_overview_selection_rows(key):
+    """Sorted row positions in df of an overview_selection_key, a box is resolved with the sorted column indexes"""
+    if key[0] == 'range':
+        _, x_col, x_range, y_col, y_range = key
+        return box_rows(get_sorted_index(x_col), x_range, get_sorted_index(y_col).values, y_range)
+    return get_selection_rows(key[1:])
+
+
+def variant_filter_key(filter_values):
+    """
+    Hashable key of the variant-filter store (value of every filter control by column), as conditions of
+    VariantIndex.filter_bitmap. Controls left at their default are dropped, None when no control filters anything.
+    """
+    key = []
+    for column, value in (filter_values or {}).items():
+        if value is None:
+            continue
+        if column in FILTER_RANGE_COLUMNS:
+            if value[0] > FILTER_BOUNDS[column][0] or value[1] < FILTER_BOUNDS[column][1]:
+                key.append(('range', column, float(value[0]), float(value[1])))
+        elif column in FILTER_THRESHOLD_COLUMNS:
+            if value > FILTER_BOUNDS[column][0]:
+                key.append(('range', column, float(value), np.inf))
+        elif column in FILTER_CATEGORIES and not set(FILTER_CATEGORIES[column]) <= set(value):
+            key.append(('in', column, tuple(sorted(value))))
+    return tuple(sorted(key)) or None
+
+
+@column_cache(FILTER_COLUMNS, maxsize=128)
+def get_filter_mask(variant_filter):
+    index = get_variant_index()
+    return np.unpackbits(index.filter_bitmap(variant_filter), count=index.n_rows).astype(bool)
+
+
+@column_cache(FILTER_COLUMNS, maxsize=128)
+def get_filter_rows(variant_filter):
+    """Row positions in df passing a variant_filter_key, all rows for None"""
+    if variant_filter is None:
+        return np.arange(len(df))
+    return np.flatnonzero(get_filter_mask(variant_filter))
+
+
+def restrict_rows(rows, variant_filter):
+    # rows passing the filter, in the same order
+    if variant_filter is None:
+        return rows
+    return rows[get_filter_mask(variant_filter)[rows]]
+
+
+def get_residue_filter(rna_threshold=DEFAULT_RNA_THRESHOLD, consequences=DEFAULT_CONSEQUENCES, tier_classes=None):
+    # residue filter key from the values of the 3D coloring controls, all classes checked meaning no class filter
+    if tier_classes is not None and set(tier_classes) >= set(dict_tier_class_green_red):
+        tier_classes = None
+    return residue_filter_key(rna_threshold, consequences, tier_classes)
+
+
+DEFAULT_RESIDUE_FILTER = get_residue_filter()
+
+
+@column_cache(RESIDUE_FILTER_COLUMNS, maxsize=64)
+def get_residue_filter_mask(residue_filter):
+    return residue_filter_mask(df, *residue_filter)
+
+
+@column_cache(RESIDUE_FILTER_COLUMNS + ['function_score_final'], maxsize=64)
+def get_residue_scores(residue_filter):
+    # per-residue mean, min and count of the function score of the variants passing the filter
+    return aggregate_residue_scores(df, get_residue_filter_mask(residue_filter), 'function_score_final')
+
+
+def get_residue_variant_rows(protein_positions, residue_filter=DEFAULT_RESIDUE_FILTER):
+    # rows of the variants passing the residue filter (default missense with RNA score >= -2) at the given positions
+    return np.flatnonzero(df['protPos'].isin(protein_positions).to_numpy(dtype=bool) & get_residue_filter_mask(residue_filter))
+
+
+def get_focus_residues(variant_ids):
+    # (chain, residue_index) of the structure for the residues of the highlighted variants
+    rows = get_selection_rows(selection_key(variant_ids))
+    positions = df['protPos'].iloc[rows].dropna().astype(int).unique()
+    return tuple(sorted(('V', int(p) - VHL_RESIDUE_OFFSET) for p in positions))
+
+
+@lru_cache(maxsize=64)
+def get_view_model(pdb_file, vizu_type, lod, focus_residues=()):
+    """
+    Level-of-detail model sent to the viewer, shared by the styling callback and the click callback (the atom ids
+    selected in the viewer are positions in this model).
+    'auto': backbone only for the atoms drawn as cartoon (ELOB, ELOC and VHL in cartoon view), same picture as 'full'
+    'backbone' / 'trace': every chain reduced, but the residues in focus (highlighted variants) keep all their atoms
+    """
+    data = load_structure(pdb_file)
+    if lod == 'full':
+        return data
+    if lod == 'auto':
+        keep_chains = ('H',) if vizu_type == 'cartoon' else ('H', 'V')
+        return reduce_model(data, 'backbone', keep_chains=keep_chains)
+    return reduce_model(data, lod, keep_residues=focus_residues)
+
+
+def get_residue_selection(atom, pdb_file, radius=0, residue_filter=DEFAULT_RESIDUE_FILTER):
+    """
+    Selection state derived from a click on the structure: the residue of the atom clicked, the VHL residues
+    within radius Å of it (when radius > 0) and their variants
+    @param atom
+    The atom clicked, or the selection state of a previous click, with keys chain, residue_name and
+    structure_residue_index
+    """
+    selection = {'chain': atom['chain'], 'residue_name': atom['residue_name'], 'residue_index': -1,
+                 'structure_residue_index': atom['structure_residue_index'],
+                 'radius': radius, 'residues': [], 'variant_ids': [], 'rows': []}
+    atom = dict(atom, residue_index=atom['structure_residue_index'])
+    # Get residue index from 60 to 209 to match the structure when VHL
+    if atom['chain'] == 'V':
+        selection['residue_index'] = atom['residue_index'] + VHL_RESIDUE_OFFSET
+        if radius:
+            structure_index = get_structure_index(pdb_file)
+            selection['residues'] = to_protein_positions(structure_index.residues_within(atom['residue_index'], radius))
+        else:
+            selection['residues'] = [selection['residue_index']]
+        rows = get_residue_variant_rows(selection['residues'], residue_filter)
+        selection['rows'] = rows.tolist()
+        selection['variant_ids'] = df['variant_id'].iloc[rows].tolist()
+    return selection
+
+
+def get_interface_selection(partner_chain, radius, residue_filter=DEFAULT_RESIDUE_FILTER):
+    """
+    Selection state of the VHL residues within radius Å of a partner chain of the VHL-ELOB-ELOC-HIF complex
+    """
+    structure_index = get_structure_index(structure_file_name(['VHL_B_H_C']))
+    residues = to_protein_positions(structure_index.interface_residues(partner_chain, radius))
+    rows = get_residue_variant_rows(residues, residue_filter)
+    return {'chain': partner_chain, 'interface': True, 'radius': radius, 'residues': residues,
+            'variant_ids': df['variant_id'].iloc[rows].tolist(), 'rows': rows.tolist()}
+
+
+def print_var_score_for_selected_residue(df, aa_name, filter_text=describe_residue_filter()):
     """
     Print all variant at the residue
     """
     if len(list(df['variant_id'])) < 1:
         text = html.Div(
             [html.Br(), html.Div(aa_name),
-             html.Div("No missense variants with RNA score ≥ -2 correspond to this residue"), html.Br()])
+             html.Div("No " + filter_text + " correspond to this residue"), html.Br()])
         return text
 
     else:
         if len(list(df['variant_id'])) == 1:
             variant_nb = 'This residue has ' + str(
-                len(list(df['variant_id']))) + ' missense variant with RNA score ≥ -2.' + '\n'
+                len(list(df['variant_id']))) + ' ' + filter_text.replace('variants', 'variant', 1) + '.' + '\n'
         if len(list(df['variant_id'])) > 1:
             variant_nb = 'This residue has ' + str(len(list(df[
-                                                                'variant_id']))) + ' missense variants with RNA score ≥ -2 with an average function score of ' + str(
-                round(list(df['average_fs_missense_at_aa_rna'])[0], 2)) + '.\n'
-
-        variant_table = html.Table(
-            [html.Tr([
-                html.Th('Variant', style={'padding': '25px'}),
-                html.Th('cHGVS', style={'padding': '25px'}),
-                html.Th('pHGVS', style={'padding': '25px'}),
-                html.Th('SGE Function Score', style={'padding': '25px'})
-            ])] +
-            [html.Tr([
-                html.Td('Variant ' + str(i + 1), style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' }),
-                html.Td(df['cHGVS'].iloc[i], style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' }),
-                html.Td(df['pHGVS'].iloc[i], style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' }),
-                html.Td(round(df['function_score_final'].iloc[i], 2), style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' })
-            ]) for i in range(len(df))],
-            style={'borderCollapse': 'collapse', 'border': '1px solid ' + light_gray})
+                                                                'variant_id']))) + ' ' + filter_text + ' with an average function score of ' + str(
+                round(df['function_score_final'].mean(), 2)) + '.\n'
+
         text = html.Div([
             html.Br(),
             html.Div(aa_name),
             html.Div(variant_nb),
             html.Br(),
             html.Br(),
-            variant_table,
+            variant_score_table(df),
         ])
 
         return text
 
 
+def print_var_score_for_selected_residues(df, title, residues, filter_text=describe_residue_filter()):
+    """
+    Print all variant of a group of residues (neighbourhood or interface selection)
+    """
+    if len(residues) == 0:
+        return html.Div([html.Br(), html.Div(title), html.Div("No VHL residue in this selection"), html.Br()])
+    residue_nb = str(len(residues)) + ' VHL residues (' + ', '.join(str(r) for r in residues) + ') with ' + \
+        str(len(df)) + ' ' + filter_text + '.'
+    if len(df) == 0:
+        return html.Div([html.Br(), html.Div(title), html.Div(residue_nb), html.Br()])
+    return html.Div([html.Br(), html.Div(title), html.Div(residue_nb), html.Br(), html.Br(), variant_score_table(df)])
+
+
+def variant_score_table(df):
+    return html.Table(
+        [html.Tr([
+            html.Th('Variant', style={'padding': '25px'}),
+            html.Th('cHGVS', style={'padding': '25px'}),
+            html.Th('pHGVS', style={'padding': '25px'}),
+            html.Th('SGE Function Score', style={'padding': '25px'})
+        ])] +
+        [html.Tr([
+            html.Td('Variant ' + str(i + 1), style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' }),
+            html.Td(df['cHGVS'].iloc[i], style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' }),
+            html.Td(df['pHGVS'].iloc[i], style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' }),
+            html.Td(round(df['function_score_final'].iloc[i], 2), style={'padding-top': '6px', 'padding-right':'25px','padding-left':'25px' })
+        ]) for i in range(len(df))],
+        style={'borderCollapse': 'collapse', 'border': '1px solid ' + light_gray})
+
+
 # MAIN ---------------------------------------------------------------------------------------------------------------
 # data
-df = pd.read_csv('https://github.com/Chloe-Terwagne/vhl_dash_board/blob/main/src/assets/input/vhl_preprocess_df.csv?raw=true')
-df['pHGVS'] = df['pHGVS'].fillna('N/A')
-df['consequence'] = df['consequence'].replace('Non synonymous', 'Missense')
+# typed schema (categoricals, float32, integer positions), see variant_table.py
+DATA_PATH = os.environ.get('VHL_DATA_PATH', 'https://github.com/Chloe-Terwagne/vhl_dash_board/blob/main/src/assets/'
+                                            'input/vhl_preprocess_df.csv?raw=true')
+
+
+def load_annotated_table(path):
+    # variant table with the annotation updates of VHL_ANNOTATION_PATH merged in, see annotation_merge.py
+    table = load_variant_table(path)
+    return merge_annotations(table, read_annotations(ANNOTATION_PATH))[0] if ANNOTATION_PATH else table
+
+
+def register_category_colors(table):
+    """
+    Give a colour and a drawing rank to the annotation categories of the table missing from their palette (a new
+    ClinVar class or cancer type brought by an annotation update), the palettes are updated in place
+    """
+    for column, palette in ANNOTATION_PALETTES.items():
+        for category in table[column].dropna().unique():
+            if category in palette:
+                continue
+            palette[category] = DICT_COL_REG[category] = DICT_COL_BLIND[category] = \
+                EXTRA_CATEGORY_COLORS[len(palette) % len(EXTRA_CATEGORY_COLORS)]
+            if category not in CATEGORY_RANK:
+                CATEGORY_RANK[category] = len(CUSTOM_CAT_ORDER)
+                CUSTOM_CAT_ORDER.append(category)
+
+
+df = load_annotated_table(DATA_PATH)
+register_category_colors(df)
+
+
+def filter_bounds(table):
+    # bounds of the sliders of the variant filters
+    return {column: (float(np.floor(table[column].min() * 10) / 10), float(np.ceil(table[column].max() * 10) / 10))
+            for column in FILTER_RANGE_COLUMNS + FILTER_THRESHOLD_COLUMNS}
+
+
+def filter_categories(table):
+    # options of the checklists of the variant filters
+    return {column: [c for c in CUSTOM_CAT_ORDER if c in set(table[column])] for column in FILTER_CATEGORY_COLUMNS}
+
+
+# variant filters applied to the overview, the 2D graph, the table and the exports
+FILTER_BOUNDS = filter_bounds(df)
+FILTER_CATEGORIES = filter_categories(df)
 exon_dict = {'exon 1b': [10141958, 10142087], 'exon 1a': [10142075, 10142202], 'exon 1p': [10142743, 10142876],
              'exon 2': [10146499, 10146644], 'exon 3a': [10149760, 10149887], 'exon 3b': [10149868, 10150002]}
 # Get text
@@ -314,23 +684,29 @@ links_content = dbc.Card(
 
 # Build your components------------------------------------------------------------------------------------------------
 # 3D parsing & styling
-parser = PdbParser('https://github.com/Chloe-Terwagne/vhl_dash_board/blob/main/src/assets/input/3d_structure/1LM8_vhl_isolated.pdb?raw=true')
-
-v_data = parser.mol3d_data()
+# level of detail of the model sent to the viewer, see get_view_model
+DEFAULT_LOD = 'auto'
+v_data = get_view_model(structure_file_name(None), 'cartoon', DEFAULT_LOD)
 styles = create_style_3d(
-    df, 'average_fs_missense_at_aa_rna', v_data['atoms'], visualization_type='cartoon', color_element='residue_score')
+    get_residue_scores(DEFAULT_RESIDUE_FILTER), 'mean', v_data['atoms'], visualization_type='cartoon',
+    color_element='residue_score')
 vhl_3D = dashbio.Molecule3dViewer(id='dashbio-default-molecule3d', modelData=v_data, styles=styles, backgroundOpacity=0,
                                   selectionType='residue', backgroundColor="black", height=600,
                                   width=735)  # ,width=735)  # , zoom=dict(factor=1.9,animationDuration=30000, fixedPath=False))
+selection_state = dcc.Store(id='selection-state')
+# selection of the overview, reduced in the browser to its box range (see reduce_overview_selection)
+overview_selection = dcc.Store(id='overview-selection')
 
 overview_title = dcc.Markdown(children='', style=dict(font_family=font_list[idx_font], font_color=yel))
+# distance used for the interface selection when the neighbourhood radius is left to 'Residue'
+DEFAULT_INTERFACE_RADIUS = 5
 list_var_to_display_first = ['c.500G>A','c.233A>G','c.292T>C','c.473T>C',
                              'c.351G>T','c.194C>G','c.484T>C','c.334T>A','c.351G>T']
 
-variant_highlight_dropd = dcc.Dropdown(options=variant_first_search_dropdown(list_var_to_display_first, df), multi=True,
+variant_highlight_dropd = dcc.Dropdown(id='variant_highlight_dropd', options=variant_first_search_dropdown(list_var_to_display_first, df), multi=True,
                                        placeholder="Select or type variant(s) to highlight",
                                        className='my-custom-dropdown', style={'z-index': '2'})
-var_table = dash_table.DataTable(data=[], columns=[], style_table={'overflowX': 'auto', 'backgroundColor': dark_gray},
+var_table = dash_table.DataTable(id='var_table', data=[], columns=[], style_table={'overflowX': 'auto', 'backgroundColor': dark_gray},
                                  cell_selectable=False,
                                  # Background color
                                  style_data={'color': yel},  # Font color for data cells
@@ -339,10 +715,64 @@ var_table = dash_table.DataTable(data=[], columns=[], style_table={'overflowX':
                                      'backgroundColor': dark_gray_transp,  # Background color for cells
                                      'border': '1px solid white'},  # Border color
                                  )
-overview_display = dcc.RadioItems(options=["SGE Function Score", "Variants expanded by nucleotide type"],
+export_scope = dcc.RadioItems(id='export-scope', options={'highlighted': 'Highlighted variants',
+                                                         'selected': 'Variants selected in the overview',
+                                                         'all': 'All variants passing the filters'},
+                              value='highlighted', labelClassName="custom-text p-3", labelStyle={'display': 'inline-block'})
+# the export inputs are posted with the download and resolved to rows by the server, see export_variants
+export_button_style = {'text-decoration': 'none', 'background': 'none', 'border': 'none'}
+export_links = html.Form([
+    dcc.Input(id='export-query', type='hidden', name='query', value=''),
+    html.Button('Download CSV', type='submit', formAction='/export/variants.csv', className='custom-link p-3',
+                style=export_button_style),
+    html.Button('Download Parquet', type='submit', formAction='/export/variants.parquet', className='custom-link p-3',
+                style=export_button_style)], method='POST')
+vcf_upload = dcc.Upload(id='vcf-upload', children=html.Div(['Drop or ', html.A('select a VCF'), ' (.vcf, .vcf.gz)'],
+                                                          className='custom-text p-3'),
+                        style={'border': '1px dashed ' + light_gray, 'border-radius': '5px', 'text-align': 'center'},
+                        multiple=False)
+vcf_status = html.Div(id='vcf-annotation-status', className='custom-text p-3')
+# Filter controls, combined in the variant-filter store by a clientside callback
+filter_label = {'function_score_final': 'SGE function score', 'rna_score': 'RNA score', 'CADD.phred': 'CADD phred ≥',
+                'REVEL': 'REVEL ≥', 'VARITY_R': 'VARITY ≥', 'max_spliceAI': 'SpliceAI ≥', 'consequence': 'Consequence',
+                'clinvar_simple': 'ClinVar', 'tier_class': 'Function Class'}
+filter_controls = {}
+filter_id = {column: 'filter-' + column.lower().replace('_', '-').replace('.', '-') for column in filter_label}
+for column in FILTER_RANGE_COLUMNS:
+    low, high = FILTER_BOUNDS[column]
+    filter_controls[column] = dcc.RangeSlider(id=filter_id[column], min=low, max=high, step=0.1,
+                                              value=[low, high], marks=None, tooltip={'placement': 'bottom'})
+for column in FILTER_THRESHOLD_COLUMNS:
+    low, high = FILTER_BOUNDS[column]
+    filter_controls[column] = dcc.Slider(id=filter_id[column], min=low, max=high, step=1 if high > 1 else 0.05,
+                                         value=low, marks=None, tooltip={'placement': 'bottom'})
+for column, categories in FILTER_CATEGORIES.items():
+    filter_controls[column] = dcc.Checklist(id=filter_id[column], options=categories,
+                                            value=categories, inline=True, labelClassName="custom-text p-3")
+variant_filter = dcc.Store(id='variant-filter')
+
+
+def reset_filter_controls():
+    # bounds, options and default values of the filter controls from FILTER_BOUNDS and FILTER_CATEGORIES, after a reload
+    for column in FILTER_RANGE_COLUMNS + FILTER_THRESHOLD_COLUMNS:
+        low, high = FILTER_BOUNDS[column]
+        control = filter_controls[column]
+        control.min, control.max, control.value = low, high, [low, high] if column in FILTER_RANGE_COLUMNS else low
+        if column in FILTER_THRESHOLD_COLUMNS:
+            control.step = 1 if high > 1 else 0.05
+    for column, categories in FILTER_CATEGORIES.items():
+        filter_controls[column].options = filter_controls[column].value = categories
+
+
+filter_panel = dbc.Row([
+    dbc.Col([html.Div(filter_label[column], className='custom-text'), filter_controls[column]], width={'size': 2})
+    for column in FILTER_RANGE_COLUMNS + FILTER_THRESHOLD_COLUMNS] + [
+    dbc.Col([html.Div(filter_label[column], className='custom-text'), filter_controls[column]], width={'size': 4})
+    for column in FILTER_CATEGORIES])
+overview_display = dcc.RadioItems(id='overview_display', options=["SGE Function Score", "Variants expanded by nucleotide type"],
                                   value='SGE Function Score', labelClassName="custom-text p-3", labelStyle={'display': 'inline-block'},
                                   style={"margin-right": "0px!important", 'padding': '0px!important'})
-overview_dropdown = dcc.Dropdown(options=[
+overview_dropdown = dcc.Dropdown(id='overview_dropdown', options=[
     {'label': 'ClinVar', 'value': 'clinvar_simple'},
     {'label': 'Consequence', 'value': 'consequence'},
     {'label': 'Function Class', 'value': 'tier_class'},
@@ -350,39 +780,72 @@ overview_dropdown = dcc.Dropdown(options=[
 ],
     placeholder="Select color category", value='consequence',
     clearable=False, className='my-custom-dropdown')
-at_scale = BooleanSwitch(on=False, size=25, label=dict(label="Genomic position at scale", style=dict(font_color=yel)),
+at_scale = BooleanSwitch(id='at_scale', on=False, size=25, label=dict(label="Genomic position at scale", style=dict(font_color=yel)),
                          color=yellow, labelPosition="left",
                          style={"margin-right": "0px", "margin-top": "0px", "margin-bottom": "-80px", 'padding': '0px'})
-overview_graph = dcc.Graph(figure={}, config={'staticPlot': False, 'scrollZoom': False, 'doubleClick': 'reset',
+overview_graph = dcc.Graph(id='overview_graph', figure={}, config={'staticPlot': False, 'scrollZoom': False, 'doubleClick': 'reset',
                                               'showTips': True, 'displayModeBar': 'hover', 'displaylogo': False,
                                               'modeBarButtonsToRemove': ['lasso2d', 'zoomIn2d', 'zoomOut2d',
                                                                          'autoScale2d']},
                            style={"margin-top": "-45px", "margin-bottom": "-75px", 'padding': '0px'}, selectedData=None)
-color_blind_option = BooleanSwitch(on=False, size=25,
+color_blind_option = BooleanSwitch(id='color_blind_option', on=False, size=25,
                                    label=dict(label="Color blind friendly", style=dict(font_color=yel)),
                                    color='rgb(80, 7, 120)', labelPosition="left")
-two_d_graph = dcc.Graph(figure={},
+heatmap_display = dcc.RadioItems(id='heatmap_display', options={'protein': 'Amino acid substitutions',
+                                                               'genomic': 'Nucleotide substitutions'},
+                                 value='protein', labelClassName="custom-text p-3", labelStyle={'display': 'inline-block'})
+heatmap_graph = dcc.Graph(id='heatmap_graph', figure={},
+                          config={'staticPlot': False, 'scrollZoom': False, 'doubleClick': 'reset', 'showTips': True,
+                                  'displayModeBar': 'hover', 'displaylogo': False, 'watermark': False})
+two_d_graph = dcc.Graph(id='two_d_graph', figure={},
                         config={'staticPlot': False, 'scrollZoom': False, 'doubleClick': 'reset', 'showTips': True,
                                 'displayModeBar': 'hover', 'displaylogo': False,
                                 'modeBarButtonsToRemove': ['lasso2d', 'select2d',
                                                            'autoScale2d'], 'watermark': False})
 two_d_title = dcc.Markdown(children='all variant')
-y_dropdown = dcc.Dropdown(options=[
+y_dropdown = dcc.Dropdown(id='y_dropdown', options=[
                           {'label': 'CADD phred', 'value': 'CADD.phred'},
                           {'label': 'VARITY', 'value': 'VARITY_R'},
                           {'label': 'REVEL', 'value': 'REVEL'},
                           {'label': 'SpliceAI', 'value': 'max_spliceAI'}],
                           value='CADD.phred', clearable=False, className='my-custom-dropdown')
-x_dropdown = dcc.Dropdown(options=[{'label': 'SGE Function Score', 'value': 'function_score_final'},
+x_dropdown = dcc.Dropdown(id='x_dropdown', options=[{'label': 'SGE Function Score', 'value': 'function_score_final'},
                                    {'label': 'RNA score', 'value': 'rna_score'}],
                           value='function_score_final', clearable=False, className='my-custom-dropdown')
-mol_viewer_colorbar = dcc.Graph(figure=color_bar_structure(),  # which return fig_color_bar,
+# rendering of the 2D plot, 'auto' switches to the density above DENSITY_THRESHOLD variants, see build_2d_figure
+DEFAULT_2D_MODE = 'auto'
+two_d_mode = dcc.RadioItems(id='two-d-mode', options={'auto': 'Auto', 'points': 'Points', 'density': 'Density'},
+                            value=DEFAULT_2D_MODE, inline=True, labelClassName="custom-text p-3")
+mol_viewer_colorbar = dcc.Graph(id='mol_viewer_colorbar',
+                                figure=color_bar_structure(residue_score_range(get_residue_scores(DEFAULT_RESIDUE_FILTER))),
                                 config={'staticPlot': True, 'scrollZoom': False, 'showTips': False,
                                         'displayModeBar': False, 'watermark': False}, style={"margin-top": '-180px'})
 pdb_selector_drop = dcc.Checklist(id='pdb-selector',
                                   options=[{'label': 'Add ELOC, ELOB and HIF 1A', 'value': 'VHL_B_H_C'}],
                                   labelClassName="custom-text p-3",
                                   style={'position': 'relative', "bottom": "-103px", "margin": "0px", "padding": "0px"})
+neighbour_radius = dcc.Slider(id='neighbour-radius', min=0, max=15, step=1, value=0,
+                              marks={0: 'Residue', 5: '5 Å', 10: '10 Å', 15: '15 Å'},
+                              tooltip={'placement': 'bottom'})
+interface_dropd = dcc.Dropdown(id='interface-chain', options=[{'label': 'HIF 1A interface', 'value': 'H'},
+                                                              {'label': 'ELOC interface', 'value': 'C'},
+                                                              {'label': 'ELOB interface', 'value': 'B'}],
+                               placeholder="Select VHL residues at an interface", className='my-custom-dropdown')
+# filters of the variants averaged per residue for the 3D coloring
+residue_rna_threshold = dcc.Slider(id='residue-rna-threshold', min=-8, max=1, step=0.5, value=DEFAULT_RNA_THRESHOLD,
+                                   marks={-8: '-8', -6: '-6', -4: '-4', -2: '-2', 0: '0'},
+                                   tooltip={'placement': 'bottom'})
+residue_consequences = dcc.Checklist(id='residue-consequences',
+                                     options=[c for c in dict_cons_colors if c in df['consequence'].unique()],
+                                     value=list(DEFAULT_CONSEQUENCES), inline=True, labelClassName="custom-text p-3")
+residue_tier_classes = dcc.Checklist(id='residue-tier-classes', options=list(dict_tier_class_green_red),
+                                     value=list(dict_tier_class_green_red), inline=True,
+                                     labelClassName="custom-text p-3")
+lod_3d = dcc.RadioItems(id='lod-3d', options={'auto': 'Auto', 'backbone': 'Backbone', 'trace': 'Cα trace',
+                                              'full': 'All atoms'},
+                        value=DEFAULT_LOD, inline=True, labelClassName="custom-text p-3")
+residue_statistic = dcc.RadioItems(id='residue-statistic', options={'mean': 'Average', 'min': 'Minimum'},
+                                   value='mean', inline=True, labelClassName="custom-text p-3")
 vizua_type_3d = dcc.RadioItems(id='vizua_type_3d', options={'sphere': 'Sphere', 'cartoon': 'Cartoon', 'stick': 'Stick'},
                                value='sphere', labelClassName="custom-text p-3", labelStyle={'display': 'inline-block'},
                                style={'position': 'relative', "bottom": "-50px", "margin": "0px", "padding": "0px"})
@@ -391,6 +854,9 @@ vizua_type_3d = dcc.RadioItems(id='vizua_type_3d', options={'sphere': 'Sphere',
 row_style = {'display': 'flex', 'flex-wrap': 'wrap', 'align-items': 'stretch'}
 app.layout = \
     dbc.Container([
+        selection_state,
+        overview_selection,
+        variant_filter,
         dbc.Row([html.Br()]),
         dbc.Row([
             dbc.Col(html.H1("Saturation Genome Editing of VHL", className='custom-h1'), width={'size': 7, 'offset': 2}, ),
@@ -403,23 +869,43 @@ app.layout = \
             dbc.Col([overview_dropdown], width={'size': 2}),
         ], justify='between'),
         dbc.Row([var_table]),
+        dbc.Row([dbc.Col(export_scope, width={'size': 8}), dbc.Col(export_links, width={'size': 4})]),
+        dbc.Row([dbc.Col(vcf_upload, width={'size': 4}), dbc.Col(vcf_status, width={'size': 8})]),
         dbc.Row([html.Br()]),
         dbc.Row([html.Br()]),
 
+        filter_panel,
+        dbc.Row([html.Br()]),
         dbc.Row([dbc.Col(overview_display),
                  ], justify='between'),
         dbc.Row([
             dbc.Col(overview_graph, width=12)
         ], justify='around'),
         dbc.Row([dbc.Col([at_scale], className="my-custom-switch", width={'size': 2, 'offset': 10})]),
+        dbc.Row([dbc.Col(heatmap_display)], justify='between'),
+        dbc.Row([dbc.Col(heatmap_graph, width=12)], justify='around'),
         # Combined Graph 2 and Graph 3 ----------------------
         dbc.Row(dbc.Col([pdb_selector_drop], width={'size': 2, 'offset': 10})),
         dbc.Row(dbc.Col([vizua_type_3d], width={'size': 3, 'offset': 6})),
+        dbc.Row([
+            dbc.Col([html.Div("Select residues within (Å) of the residue clicked", className='custom-text'),
+                     neighbour_radius], width={'size': 3, 'offset': 6}),
+            dbc.Col([interface_dropd], width={'size': 3}),
+        ]),
+        dbc.Row([
+            dbc.Col([html.Div("Residue score: RNA score ≥", className='custom-text'), residue_rna_threshold,
+                     residue_statistic], width={'size': 3, 'offset': 6}),
+            dbc.Col([residue_consequences, residue_tier_classes], width={'size': 3}),
+        ]),
+        dbc.Row(dbc.Col([html.Div("Level of detail of the structure", className='custom-text'), lod_3d],
+                        width={'size': 6, 'offset': 6})),
         dbc.Row(
             [
                 # Graph 2
                 dbc.Col(
                     [
+                        dbc.Row(dbc.Col([html.Div("Rendering of the variants", className='custom-text'),
+                                         two_d_mode])),
                         two_d_graph,
                         dbc.Row(
                             [
@@ -453,8 +939,8 @@ app.layout = \
                         dbc.Row(vhl_3D),  # 3D protein
                         dbc.Row(dbc.Col([mol_viewer_colorbar], md=6)),
                         dbc.Row(dbc.Col(
-                            html.H1("Averaged missense variant function score per residue mapped on VHL structure",
-                                    className='custom-h1', style={
+                            html.H1(structure_title(DEFAULT_RESIDUE_FILTER, residue_statistic.value),
+                                    id='structure-title', className='custom-h1', style={
                                     'font-size': '18pt', 'text-align': 'left', "margin-left": '45px',
                                     "margin-top": '-80px', 'position': 'relative'}), width={'size': 9, 'offset': 2})),
                         dbc.Row([
@@ -496,23 +982,156 @@ app.layout = \
     ], fluid=True)
 
 
+# Export --------------------------------------------------------------------------------
+EXPORT_COLUMNS = [c for c in df.columns if not c.startswith('Unnamed')]
+
+
+@server.route('/export/variants.<export_format>', methods=['POST'])
+def export_variants(export_format):
+    """
+    Stream the rows of the posted export query (scope, highlighted variants, overview selection and filters, see
+    the export-query clientside callback) chunk by chunk, without a filtered copy of df
+    """
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    df_export = df
+    try:
+        scope, highlight_var, selection, filter_values = json.loads(request.form.get('query', ''))
+        rows = get_export_rows(scope, highlight_var, selection, filter_values)
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return 'Invalid export query, refresh the page and download again.', 400
+    iter_rows = iter_csv if export_format == 'csv' else iter_parquet
+    return Response(stream_with_context(iter_rows(df_export, rows, EXPORT_COLUMNS)),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': 'attachment; filename=vhl_sge_variants.' + export_format})
+
+
+# Batch score lookup for pipelines, outside of the dash callbacks
+API_MAX_VARIANTS = int(os.environ.get('VHL_API_MAX_VARIANTS', 10000))
+API_MAX_BYTES = API_MAX_VARIANTS * 100
+
+
+@server.route('/api/variants/scores', methods=['POST'])
+def lookup_variant_scores():
+    """
+    Scores of a batch of variants, the body being one of
+    {"variant_ids": [...]}, {"cHGVS": [...]} or {"positions": [[hg38_pos, ref, alt], ...]}
+    Answer 413 above VHL_API_MAX_VARIANTS variants and 400 for a malformed body.
+    """
+    if request.content_length is None:
+        abort(411)
+    if request.content_length > API_MAX_BYTES:
+        abort(413)
+    try:
+        key, values = parse_lookup_request(request.get_json(force=True, silent=True))
+    except ValueError as error:
+        return {'error': str(error)}, 400
+    if len(values) > API_MAX_VARIANTS:
+        return {'error': 'At most %d variants per request' % API_MAX_VARIANTS}, 413
+    rows = get_variant_lookup().rows(key, values)
+    return Response(stream_with_context(iter_lookup_json(df, values, rows)), mimetype='application/json')
+
+
+# Annotated VCF files of the uploads, removed after ANNOTATED_VCF_MAX_AGE seconds
+ANNOTATED_VCF_DIR = os.path.join(tempfile.gettempdir(), 'vhl_annotated_vcf')
+ANNOTATED_VCF_MAX_AGE = 3600
+
+
+def remove_old_files(directory, max_age):
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+@server.route('/download/annotated/<token>.vcf')
+def download_annotated_vcf(token):
+    path = os.path.join(ANNOTATED_VCF_DIR, token + '.vcf')
+    if not re.fullmatch(r'[0-9a-f]{32}', token) or not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype='text/vcf', as_attachment=True, download_name='vhl_sge_annotated.vcf')
+
+
 # Callback --------------------------------------------------------------------------------
+@app.callback(
+    Output(variant_highlight_dropd, 'value', allow_duplicate=True),
+    Output('vcf-annotation-status', 'children'),
+    Input('vcf-upload', 'contents'),
+    State('vcf-upload', 'filename'),
+    prevent_initial_call=True
+)
+@profiled('annotate_uploaded_vcf')
+def annotate_uploaded_vcf(contents, filename):
+    # annotate the uploaded VCF chunk by chunk into a file to download, and highlight its assayed variants
+    if contents is None:
+        return no_update, no_update
+    remove_old_files(ANNOTATED_VCF_DIR, ANNOTATED_VCF_MAX_AGE)
+    os.makedirs(ANNOTATED_VCF_DIR, exist_ok=True)
+    token = uuid.uuid4().hex
+    path = os.path.join(ANNOTATED_VCF_DIR, token + '.vcf')
+    try:
+        with open(path, 'w') as out:
+            annotator = VcfAnnotator(df, get_variant_lookup()).annotate(iter_lines(iter_upload_bytes(contents)), out)
+    except ValueError:
+        if os.path.exists(path):
+            os.remove(path)
+        return no_update, 'Could not read ' + str(filename) + ': not a VCF, plain or gzip compressed.'
+    matched = annotator.matched_variant_ids
+    summary = '%s: %d records, %d alleles, %d assayed by SGE. ' % (filename, annotator.records, annotator.alleles,
+                                                                  len(matched))
+    # a VCF without any assayed variant leaves the current highlight as it is
+    return matched or no_update, [summary, html.A('Download the annotated VCF', href='/download/annotated/%s.vcf' % token,
+                                     className='custom-link')]
+
+
+# inputs of the export posted with the download form, kept in the browser: the form works on any instance, at any time
+app.clientside_callback(
+    """
+    function(scope, highlightVar, selection, filterValues) {
+        return JSON.stringify([scope, highlightVar, selection, filterValues]);
+    }
+    """,
+    Output('export-query', 'value'),
+    Input('export-scope', 'value'),
+    Input(variant_highlight_dropd, 'value'),
+    Input(overview_selection, 'data'),
+    Input(variant_filter, 'data'),
+)
+
+
+def get_export_rows(scope, highlight_var, selection, filter_values):
+    # row positions of an export scope in the current table, resolved by the cached selection and filter resolvers
+    if scope == 'all' or scope == 'selected' and selection is None:
+        rows = np.arange(len(df))
+    elif scope == 'selected':
+        rows = get_overview_selection_rows(overview_selection_key(selection))
+    else:
+        rows = get_selection_rows(selection_key(highlight_var))
+    return restrict_rows(rows, variant_filter_key(filter_values))
+
+
 @app.callback(
     Output(var_table, 'data'),
     Output(var_table, 'columns'),
-    Input(variant_highlight_dropd, 'value')
+    Input(variant_highlight_dropd, 'value'),
+    Input(variant_filter, 'data')
 )
-def update_datatable(selected_variants):
+def update_datatable(selected_variants, filter_values):
     # If no variants are selected, show an empty DataTable
     if selected_variants is None or selected_variants == []:
         data, col = [], []
         return data, col
 
-    # Filter the DataFrame based on selected variants
-    subset_df = df[df['variant_id'].isin(selected_variants)]
+    # Filter the DataFrame based on selected variants and on the variant filters
+    subset_df = df.iloc[restrict_rows(get_selection_rows(selection_key(selected_variants)),
+                                      variant_filter_key(filter_values))]
 
-    # Create DataTable data and columns from the subset_df
-    data = subset_df.to_dict('records')
+    # Create DataTable data and columns from the subset_df, only the columns displayed are sent
     col = [
         {'name': 'Variant', 'id': 'variant_id'},
         {'name': 'cHGVS', 'id': 'cHGVS'},
@@ -523,6 +1142,7 @@ def update_datatable(selected_variants):
         {'name': 'RNA score', 'id': 'rna_score', 'type': 'numeric', 'format': {'specifier': '.2f'}},
         {'name': 'ClinVar', 'id': 'clinvar_simple'}
     ]
+    data = subset_df[[c['id'] for c in col]].to_dict('records')
     return data, col
 
 
@@ -532,17 +1152,27 @@ def update_datatable(selected_variants):
     Input(overview_display, 'value'),
     Input(color_blind_option, 'on'),
     Input(at_scale, 'on'),
-    Input(variant_highlight_dropd, 'value')
+    Input(variant_highlight_dropd, 'value'),
+    Input(variant_filter, 'data')
 )
-def update_overview_graph(column_name, y_axis_nucleotide, color_blind, at_scale, variant_highlight):
-    df_temp = df
-    if at_scale:
-        x_overv = 'hg38_pos'
-    else:
-        x_overv = 'index'
+def update_overview_graph(column_name, y_axis_nucleotide, color_blind, at_scale, variant_highlight, filter_values):
+    return build_overview_figure(column_name, y_axis_nucleotide, bool(color_blind), bool(at_scale),
+                                 selection_key(variant_highlight), variant_filter_key(filter_values))
+
+
+@column_cache(FIGURE_COLUMNS, maxsize=128)
+@profiled('build_overview_figure')
+def build_overview_figure(column_name, y_axis_nucleotide, color_blind, at_scale, variant_highlight,
+                          variant_filter=None):
+    """
+    Overview figure, cached per combination of inputs (variant_highlight is a selection_key, variant_filter a
+    variant_filter_key)
+    """
+    df_temp = df if variant_filter is None else df.iloc[get_filter_rows(variant_filter)]
+    x_overv, y_axis = overview_axes(at_scale, y_axis_nucleotide)
 
     # Get transparency if variant selected
-    if variant_highlight is None or variant_highlight == []:
+    if not variant_highlight:
         transparency, mark_size, marker_line_width, ref_col = 1, 8, 0, yellow
     else:
         transparency, mark_size, marker_line_width, ref_col = 0.45, 8, 3, yel
@@ -554,43 +1184,28 @@ def update_overview_graph(column_name, y_axis_nucleotide, color_blind, at_scale,
 
     height_grph, marker_symb = 340, "circle"
     limit = (-3.745898895, 0.590402626)
-    y_axis = 'function_score_final'
     yaxis_dict = dict(showgrid=True, gridcolor=yel_exon, visible=True, zeroline=False, linecolor=None, linewidth=1,
                       title='Function Score')
     xaxis_dict = dict(showgrid=False, visible=True, zeroline=False, linecolor=None, linewidth=1, showticklabels=False,
                       title="Unscaled Genomic Position")
 
     if y_axis_nucleotide == "Variants expanded by nucleotide type":
-        marker_symb, y_axis, height_grph = "square", 'alt_pos', 340
+        marker_symb, height_grph = "square", 340
         yaxis_dict = dict(showgrid=False, zeroline=False, title='Nucleotide',
                           tickvals=[-3.745898895, -2.3004650546666667, -0.8550312143333332, 0.590402626],
                           ticktext=['T', 'G', 'C', 'A'])
 
-    fig = go.Figure()
-    # Iterate through the unique categories in your data in the custom order
-    for category in CUSTOM_CAT_ORDER:
-        if category in df_temp[column_name].unique():
-            category_data = df_temp[df_temp[column_name] == category]
-            scatter_trace = go.Scatter(
-                x=category_data[x_overv],
-                y=category_data[y_axis],
-                mode='markers',
-                customdata=category_data[hover_columns],
-                marker=dict(size=mark_size, symbol=marker_symb, color=colors[category], opacity=transparency),
-                hovertemplate="<br>".join(hover_text),
-                name=category)
-
-            # Add the Scatter trace to the figure
-            fig.add_trace(scatter_trace)
+    fig = go.Figure(category_traces(df_temp, column_name, x_overv, y_axis, colors,
+                                    dict(size=mark_size, symbol=marker_symb, opacity=transparency)))
 
     # re-plot highlighted variants
-    if variant_highlight is not None and variant_highlight != []:
-        subset_var_highlight_df = df_temp[df_temp['variant_id'].isin(variant_highlight)]
+    if variant_highlight:
+        subset_var_highlight_df = df.iloc[restrict_rows(get_selection_rows(variant_highlight), variant_filter)]
         highlight_trace = go.Scatter(
             x=subset_var_highlight_df[x_overv],
             y=subset_var_highlight_df[y_axis],
             mode='markers',
-            customdata=subset_var_highlight_df[hover_columns],
+            customdata=round_columns(subset_var_highlight_df[hover_columns]),
             marker=dict(size=mark_size + 2, symbol=marker_symb, line=dict(width=marker_line_width, color=yellow),
                         color=[colors[key] for key in subset_var_highlight_df[column_name]]),
             hovertemplate="<br>".join(hover_text),
@@ -674,19 +1289,105 @@ def update_overview_graph(column_name, y_axis_nucleotide, color_blind, at_scale,
             color=yellow)
     )
 
-    return fig.update_layout(uirevision=True)
+    return compact_figure(fig.update_layout(uirevision=True))
+
+
+# Combine the filter controls into the variant-filter store: {column: value of its control}
+app.clientside_callback(
+    """
+    function() {
+        var columns = %s;
+        var filter = {};
+        for (var i = 0; i < columns.length; i++) {
+            filter[columns[i]] = arguments[i];
+        }
+        return filter;
+    }
+    """ % json.dumps(list(filter_controls)),
+    Output(variant_filter, 'data'),
+    [Input(control, 'value') for control in filter_controls.values()],
+)
+
+
+# Reduce the selectedData of the overview to its box range, or to the variant ids of the points (reference alleles
+# have no customdata) when there is no range, so that the upload does not grow with the number of points selected
+app.clientside_callback(
+    """
+    function(selectedData, atScale, display) {
+        if (!selectedData) {
+            return null;
+        }
+        if (selectedData.range && selectedData.range.x && selectedData.range.y) {
+            return {range: {x: selectedData.range.x, y: selectedData.range.y}, at_scale: atScale, display: display};
+        }
+        var ids = (selectedData.points || []).filter(function(p) { return p.customdata; })
+                                             .map(function(p) { return p.customdata[0]; });
+        return {variant_ids: ids};
+    }
+    """,
+    Output(overview_selection, 'data'),
+    Input(overview_graph, 'selectedData'),
+    State(at_scale, 'on'),
+    State(overview_display, 'value'),
+)
 
 
 @app.callback(
     Output(component_id=two_d_graph, component_property='figure'),
     Input(overview_dropdown, 'value'),
-    Input(component_id=overview_graph, component_property="selectedData"),
+    Input(overview_selection, 'data'),
     Input(x_dropdown, 'value'),
     Input(y_dropdown, 'value'),
     Input(variant_highlight_dropd, 'value'),
-    Input(color_blind_option, 'on')
+    Input(color_blind_option, 'on'),
+    Input(variant_filter, 'data'),
+    Input(two_d_mode, 'value')
 )
-def update_2d_graph(color_column, slct_data, x_col, y_col, highlight_var, color_blind):
+def update_2d_graph(color_column, selection, x_col, y_col, highlight_var, color_blind, filter_values, mode):
+    return build_2d_figure(color_column, overview_selection_key(selection), x_col, y_col, selection_key(highlight_var),
+                           bool(color_blind), variant_filter_key(filter_values), mode)
+
+
+TWO_D_AXIS_COLUMNS = [o['value'] for o in x_dropdown.options + y_dropdown.options]
+
+
+def get_2d_rows(selected_variants, variant_filter):
+    """Row positions of the variants of the 2D plot, None for all the variants"""
+    if selected_variants is not None:
+        return restrict_rows(get_overview_selection_rows(selected_variants), variant_filter)
+    return get_filter_rows(variant_filter) if variant_filter is not None else None
+
+
+@column_cache(FILTER_COLUMNS + OVERVIEW_AXIS_COLUMNS + TWO_D_AXIS_COLUMNS, maxsize=32)
+@profiled('get_density_grid')
+def get_density_grid(x_col, y_col, selected_variants, variant_filter):
+    """
+    density_grid of the variants of the 2D plot, cached per axes, selection and filter: changing the colour or the
+    highlighted variants does not recompute it
+    @return
+    (counts, x bin edges, y bin edges, row positions of the sparse variants)
+    """
+    rows = get_2d_rows(selected_variants, variant_filter)
+    data = df if rows is None else df.iloc[rows]
+    counts, x_edges, y_edges, sparse = density_grid(data[x_col].to_numpy(dtype=float, na_value=np.nan),
+                                                    data[y_col].to_numpy(dtype=float, na_value=np.nan))
+    return counts, x_edges, y_edges, sparse if rows is None else rows[sparse]
+
+
+@column_cache(FIGURE_COLUMNS + TWO_D_AXIS_COLUMNS, maxsize=128)
+@profiled('build_2d_figure')
+def build_2d_figure(color_column, selected_variants, x_col, y_col, highlight_var, color_blind, variant_filter=None,
+                    mode=DEFAULT_2D_MODE):
+    """
+    2D figure, cached per combination of inputs
+    @param selected_variants
+    overview_selection_key of the variants selected in the overview, None when nothing is selected
+    @param variant_filter
+    variant_filter_key of the filter controls, None when nothing is filtered
+    @param mode
+    'points' draws every variant, 'density' a 2D histogram of the variants with the outliers and highlighted variants
+    as points, 'auto' the density above DENSITY_THRESHOLD variants
+    """
     black3dbg = dict(showgrid=True, gridcolor=yel_exon, gridwidth=0.5,
                      zeroline=False)
 
@@ -695,70 +1396,55 @@ def update_2d_graph(color_column, slct_data, x_col, y_col, highlight_var, color_
     else:
         colors = DICT_COL_REG
 
+    dict_label_axis = {'CADD.phred': 'CADD phred', 'VARITY_R': 'VARITY', 'REVEL': 'REVEL', 'max_spliceAI': 'SpliceAI', 'function_score_final': 'SGE Function Score', 'rna_score': 'RNA score'}
+    dict_label_leg = {'clinvar_simple': 'ClinVar', 'consequence': 'Consequence', 'tier_class': 'Function Class', 'Cancer_type_single': 'Cancer Type'}
+
     df_t = df
     fig2 = go.Figure()
 
+    selected_rows = get_2d_rows(selected_variants, variant_filter)
     #  selection with no points inside
-    if slct_data is not None and slct_data['points'] == []:
+    if selected_variants is not None and len(selected_rows) == 0:
         empty_trace = go.Scatter()
         fig2.add_trace(empty_trace)
         title = "Please select at least one variant"
 
     else:
         # if subset of point( >< not all points)
-        if (slct_data is not None) and slct_data != {'points': []}:
-            # Remove reference allele from slct_data -> remove points that doesn't have custom data columns
-            slct_data['points'] = [point for point in slct_data['points'] if 'customdata' in point]
-
-            if not slct_data['points']:
-                empty_trace = go.Scatter()
-                fig2.add_trace(empty_trace)
-                title = "Please select at least one variant"
-            else:
-                # subset data based on selection
-                var = [slct_data['points'][i]['customdata'][0] for i in range(len(slct_data['points']))]
-                df_t = df_t[df_t.variant_id.isin(var)]
-                title = "Variants selected"
+        if selected_variants is not None:
+            # subset data based on selection
+            df_t = df_t.iloc[selected_rows]
+            title = "Variants selected"
         else:
+            df_t = df_t.iloc[selected_rows] if selected_rows is not None else df_t
             subtittle = "<br><sup>Choose the rectangle tool in the menu bar of the gene overview above to subset variants of interest.</sup>"
             title = "All variants" + subtittle
 
         # highlighted variants settings
-        if highlight_var is not None and highlight_var != []:
+        if highlight_var:
             transparency = 0.45
             # Create a DataFrame for highlighted points
-            subset_var_highlight_df = df_t[df_t['variant_id'].isin(highlight_var)]
+            subset_var_highlight_df = df.iloc[get_selection_rows(highlight_var)]
+            subset_var_highlight_df = subset_var_highlight_df[subset_var_highlight_df.index.isin(df_t.index)]
         else:
             transparency = 1
             subset_var_highlight_df = pd.DataFrame()
 
-        # Iterate through the unique categories in your data in the custom order
-        for category in CUSTOM_CAT_ORDER:
-            # Iterate through the unique categories in your data
-            if category in df_t[color_column].unique():
-                # Filter data for the current category
-                category_data = df_t[df_t[color_column] == category]
-
-                # Create a Scatter trace for the current category
-                scatter_trace = go.Scatter(
-                    x=category_data[x_col],
-                    y=category_data[y_col],
-                    mode='markers',
-                    customdata=category_data[hover_columns],
-                    marker=dict(
-                        size=6,
-                        color=colors[category],  # Use color from dict_color_consq
-                        opacity=transparency
-                    ),
-                    hovertemplate="<br>".join(hover_text),
-                    name=category  # Set the name for the legend
-                )
-
-                # Add the Scatter trace to the figure
-                fig2.add_trace(scatter_trace)
+        if mode == 'density' or (mode == 'auto' and len(df_t) > DENSITY_THRESHOLD):
+            counts, x_edges, y_edges, sparse_rows = get_density_grid(x_col, y_col, selected_variants, variant_filter)
+            fig2.add_trace(go.Heatmap(
+                x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2,
+                z=np.where(counts.T > 0, counts.T, np.nan), colorscale=DENSITY_COLORSCALE, hoverongaps=False,
+                colorbar=dict(title='Variants', thickness=12, outlinewidth=0, x=1.02),
+                hovertemplate=dict_label_axis[x_col] + ": %{x:.2f}<br>" + dict_label_axis[y_col] +
+                ": %{y:.2f}<br>Variants: %{z}<extra></extra>", name='Density'))
+            # the outliers keep their category colour
+            df_t = df.iloc[sparse_rows]
+
+        fig2.add_traces(category_traces(df_t, color_column, x_col, y_col, colors, dict(size=6, opacity=transparency)))
 
         # plot variant to highlight
-        if highlight_var is not None and highlight_var != []:
+        if highlight_var:
             highlight_trace = go.Scatter(
                 x=subset_var_highlight_df[x_col],
                 y=subset_var_highlight_df[y_col],
@@ -769,14 +1455,11 @@ def update_2d_graph(color_column, slct_data, x_col, y_col, highlight_var, color_
                     line=dict(width=3, color=yellow),
                     autocolorscale=True,
                     color=yellow),
-                customdata=subset_var_highlight_df[hover_columns],
+                customdata=round_columns(subset_var_highlight_df[hover_columns]),
                 hovertemplate="<br>".join(hover_text),
                 name="Highlited variants")
             fig2.add_trace(highlight_trace)
 
-    dict_label_axis = {'CADD.phred': 'CADD phred', 'VARITY_R': 'VARITY', 'REVEL': 'REVEL', 'max_spliceAI': 'SpliceAI', 'function_score_final': 'SGE Function Score', 'rna_score': 'RNA score'}
-    dict_label_leg = {'clinvar_simple': 'ClinVar', 'consequence': 'Consequence', 'tier_class': 'Function Class', 'Cancer_type_single': 'Cancer Type'}
-
     # Make it looks cute
     fig2.update_layout(plot_bgcolor=dark_gray,
                        xaxis_title=dict(text=dict_label_axis[x_col], font=dict(color=yel)),
@@ -801,7 +1484,71 @@ def update_2d_graph(color_column, slct_data, x_col, y_col, highlight_var, color_
                            color=yellow)
                        )
 
-    return fig2.update_layout(uirevision=True)
+    return compact_figure(fig2.update_layout(uirevision=True))
+
+
+@app.callback(
+    Output(heatmap_graph, 'figure'),
+    Input(heatmap_display, 'value'),
+    Input(color_blind_option, 'on')
+)
+def update_heatmap_graph(view, color_blind):
+    return build_substitution_heatmap(view, bool(color_blind))
+
+
+@column_cache(['nAA', 'protPos', 'alt', 'hg38_pos', 'function_score_final'], maxsize=None)
+@profiled('build_substitution_heatmap')
+def build_substitution_heatmap(view, color_blind):
+    """
+    Mean function score per position and substitution, one pivot of the table per view and colour setting.
+    The payload grows with the number of positions, not with the number of variants.
+    """
+    row_column, column_column, row_order, x_title, y_title = HEATMAP_VIEWS[view]
+    data = df[df[column_column].notna()]
+    grid = data.pivot_table(index=row_column, columns=column_column, values='function_score_final', aggfunc='mean',
+                            observed=True)
+    grid = grid.reindex([row for row in row_order if row in grid.index])
+    heatmap = go.Heatmap(
+        x=grid.columns.to_numpy(dtype=float), y=list(grid.index), z=grid.to_numpy(dtype=float),
+        colorscale=HEATMAP_COLORSCALE_BLIND if color_blind else HEATMAP_COLORSCALE_REG,
+        zmin=float(df['function_score_final'].min()), zmax=float(df['function_score_final'].max()),
+        hoverongaps=False, xgap=1, ygap=1,
+        colorbar=dict(title='Function<br>Score', thickness=12, outlinewidth=0),
+        hovertemplate=x_title + ": %{x}<br>" + y_title + ": %{y}<br>SGE function score: %{z:.2f}<extra></extra>")
+
+    fig = go.Figure(heatmap)
+    fig.update_layout(
+        plot_bgcolor=transparent,
+        paper_bgcolor=transparent,
+        height=340 if view == 'protein' else 200,
+        xaxis=dict(type='category', showgrid=False, zeroline=False, title=x_title, nticks=20),
+        yaxis=dict(showgrid=False, zeroline=False, title=y_title, autorange='reversed', dtick=1),
+        font_family=font_list[idx_font],
+        font_color=yel,
+        modebar=dict(
+            bgcolor=transparent,
+            activecolor=yel,
+            color=yellow)
+    )
+    return compact_figure(fig.update_layout(uirevision=True))
+
+
+@app.callback(
+    Output(variant_highlight_dropd, 'value', allow_duplicate=True),
+    Input(heatmap_graph, 'clickData'),
+    State(heatmap_display, 'value'),
+    prevent_initial_call=True
+)
+def highlight_heatmap_cell(click_data, view):
+    # highlight the variants of the clicked cell
+    if not click_data or not click_data.get('points'):
+        return no_update
+    point = click_data['points'][0]
+    row_column, column_column = HEATMAP_VIEWS[view][:2]
+    variants = df.loc[(df[column_column] == float(point['x'])) & (df[row_column] == point['y']), 'variant_id']
+    if variants.empty:
+        return no_update
+    return list(variants)
 
 
 @app.callback(
@@ -810,73 +1557,182 @@ def update_2d_graph(color_column, slct_data, x_col, y_col, highlight_var, color_
     Input('pdb-selector', 'value'),
     Input('vizua_type_3d', 'value'),
     Input(variant_highlight_dropd, 'value'),
+    Input('residue-rna-threshold', 'value'),
+    Input('residue-consequences', 'value'),
+    Input('residue-tier-classes', 'value'),
+    Input('residue-statistic', 'value'),
+    Input('lod-3d', 'value'),
 )
-def update_stucture_based_dropdown(selected_pdb_file, vizu_type, highlight_var):
-    data = get_structure_file(selected_pdb_file)
+def update_stucture_based_dropdown(selected_pdb_file, vizu_type, highlight_var, rna_threshold, consequences,
+                                   tier_classes, statistic, lod):
+    return build_structure_view(structure_file_name(selected_pdb_file), vizu_type, selection_key(highlight_var),
+                                get_residue_filter(rna_threshold, consequences, tier_classes), statistic, lod)
+
+
+@column_cache(RESIDUE_FILTER_COLUMNS + ['function_score_final', 'variant_id'], maxsize=128)
+@profiled('build_structure_view')
+def build_structure_view(pdb_file, vizu_type, highlight_var, residue_filter, statistic, lod):
+    """
+    Model and styles of the 3D viewer, cached per combination of inputs
+    """
+    data = get_view_model(pdb_file, vizu_type, lod, get_focus_residues(highlight_var))
+    residue_scores = get_residue_scores(residue_filter)
+    # residues of the highlighted variants entering the residue scores
+    rows = get_selection_rows(highlight_var)
+    protein_positions = df['protPos'].to_numpy(dtype=float, na_value=np.nan)
+    highlight_residues = set(protein_positions[rows[get_residue_filter_mask(residue_filter)[rows]]].astype(int))
     styles = create_style_3d(
-        df, 'average_fs_missense_at_aa_rna', data['atoms'], visualization_type=vizu_type,
-        color_element='residue_score', hightlight_vars=highlight_var)
+        residue_scores, statistic, data['atoms'], visualization_type=vizu_type,
+        color_element='residue_score', highlight_residues=highlight_residues,
+        score_range=residue_score_range(residue_scores, statistic))
     return data, styles
 
 
 @app.callback(
-    Output(variant_highlight_dropd, 'value'),
-    Input('dashbio-default-molecule3d', 'selectedAtomIds'),
-    Input('pdb-selector', 'value'),
+    Output('mol_viewer_colorbar', 'figure'),
+    Output('structure-title', 'children'),
+    Input('residue-rna-threshold', 'value'),
+    Input('residue-consequences', 'value'),
+    Input('residue-tier-classes', 'value'),
+    Input('residue-statistic', 'value'),
 )
-def update_dropdown_based_stucture(atom_ids, selected_pdb_file):
-    data = get_structure_file(selected_pdb_file)
-    list_var = []  # variants list selected to put in dropdown
-    # Get residue index from 60 to 209 to match the structure when VHL
-    for elem in data['atoms']:
-        if elem['chain'] == 'V':
-            elem['residue_index'] = elem['residue_index'] + 60
-        else:
-            elem['residue_index'] = -1
-
-    if atom_ids is not None and len(atom_ids) > 0:
-        last_atom_dict = data['atoms'][atom_ids[-1]]
-        subset_df = df.loc[
-            (df['protPos'] == last_atom_dict['residue_index']) & (~df['average_fs_missense_at_aa_rna'].isna())]
-
-        if len(list(subset_df['variant_id'])) >= 1:
-            list_var = list(subset_df['variant_id'])
-    return list_var
+def update_structure_colorbar(rna_threshold, consequences, tier_classes, statistic):
+    # the colour bar and the title of the structure follow the residue filters and statistic
+    residue_filter = get_residue_filter(rna_threshold, consequences, tier_classes)
+    residue_scores = get_residue_scores(residue_filter)
+    return color_bar_structure(residue_score_range(residue_scores, statistic)), \
+        structure_title(residue_filter, statistic)
 
 
 @app.callback(
+    Output(variant_highlight_dropd, 'value'),
     Output('default-molecule3d-output', 'children'),
+    Output('selection-state', 'data'),
     Input('dashbio-default-molecule3d', 'selectedAtomIds'),
-    Input('pdb-selector', 'value')
+    Input('pdb-selector', 'value'),
+    Input('neighbour-radius', 'value'),
+    Input('interface-chain', 'value'),
+    State('residue-rna-threshold', 'value'),
+    State('residue-consequences', 'value'),
+    State('residue-tier-classes', 'value'),
+    State('vizua_type_3d', 'value'),
+    State('lod-3d', 'value'),
+    State(variant_highlight_dropd, 'value'),
+    State('selection-state', 'data'),
 )
-def show_selected_residue(atom_ids, selected_pdb_file):
-    data = get_structure_file(selected_pdb_file)
-
+@profiled('update_residue_selection')
+def update_residue_selection(atom_ids, selected_pdb_file, radius, interface_chain, rna_threshold, consequences,
+                             tier_classes, vizu_type, lod, highlight_var, previous_selection):
+    # one pass for a click on the structure: the dropdown value, the residue description and the selection state
     chain_dict = {'H': 'HIF 1A', 'V': 'VHL', 'C': "ELOC", 'B': "ELOB"}
-    # Get residue index from 60 to 209 to match the structure when VHL
-    for elem in data['atoms']:
-        if elem['chain'] == 'V':
-            elem['residue_index'] = elem['residue_index'] + 60
-        else:
-            elem['residue_index'] = -1
-
-    if atom_ids is None or len(atom_ids) == 0:
-        return 'Click somewhere on the VHL protein structure to select an amino acid.'
-
+    residue_filter = get_residue_filter(rna_threshold, consequences, tier_classes)
+    filter_text = describe_residue_filter(*residue_filter)
+    if interface_chain and (ctx.triggered_id == 'interface-chain' or not atom_ids):
+        selection = get_interface_selection(interface_chain, radius or DEFAULT_INTERFACE_RADIUS, residue_filter)
+        title = 'VHL residues within ' + str(selection['radius']) + ' Å of ' + chain_dict[interface_chain]
+        return selection['variant_ids'], print_var_score_for_selected_residues(
+            df.iloc[selection['rows']], title, selection['residues'], filter_text), selection
+
+    pdb_file = structure_file_name(selected_pdb_file)
+    if atom_ids and ctx.triggered_id == 'dashbio-default-molecule3d':
+        # atom ids are positions in the model displayed when the atom was clicked
+        atom = get_view_model(pdb_file, vizu_type, lod, get_focus_residues(highlight_var))['atoms'][atom_ids[-1]]
+        atom = dict(atom, structure_residue_index=atom['residue_index'])
+    elif atom_ids and previous_selection and 'structure_residue_index' in previous_selection:
+        # radius or structure changed: keep the residue clicked, the model may have changed since
+        atom = previous_selection
     else:
-        last_atom_dict = data['atoms'][atom_ids[-1]]
-        # return Only protein / Chain when not VHL
-        if (last_atom_dict['chain'] == 'C') or (last_atom_dict['chain'] == 'H') or (last_atom_dict['chain'] == 'B'):
-            prot = 'Chain: ', chain_dict[str(last_atom_dict['chain'])],
-            phr1 = 'Click somewhere on the VHL protein structure to select an amino acid.'
-            return html.Div([html.Br(), html.Div(prot), html.Br(), html.Div(phr1), html.Br()])
-
-    aa_name = 'Reference amino acid: ', last_atom_dict['residue_name'], \
-        ', position: ', str(last_atom_dict['residue_index'])
-    subset_df = df.loc[(df['protPos'] == last_atom_dict['residue_index']) &
-                       (~df['average_fs_missense_at_aa_rna'].isna())]
-    return print_var_score_for_selected_residue(subset_df, aa_name)
-
+        return [], 'Click somewhere on the VHL protein structure to select an amino acid.', None
+    selection = get_residue_selection(atom, pdb_file, radius, residue_filter)
+
+    # return Only protein / Chain when not VHL
+    if selection['chain'] in ['C', 'H', 'B']:
+        prot = 'Chain: ', chain_dict[str(selection['chain'])],
+        phr1 = 'Click somewhere on the VHL protein structure to select an amino acid.'
+        return [], html.Div([html.Br(), html.Div(prot), html.Br(), html.Div(phr1), html.Br()]), selection
+
+    aa_name = 'Reference amino acid: ', selection['residue_name'], \
+        ', position: ', str(selection['residue_index'])
+    subset_df = df.iloc[selection['rows']]
+    if radius:
+        aa_name = aa_name + (', residues within ' + str(radius) + ' Å',)
+        return selection['variant_ids'], print_var_score_for_selected_residues(
+            subset_df, aa_name, selection['residues'], filter_text), selection
+    return selection['variant_ids'], print_var_score_for_selected_residue(subset_df, aa_name, filter_text), selection
+
+
+# Warm-up ---------------------------------------------------------------------------------------------------------------
+def warmup_tasks():
+    """Most common input combinations of the figure callbacks: the page load defaults and the first user choices"""
+    tasks = []
+    for color_column in [o['value'] for o in overview_dropdown.options]:
+        for display in overview_display.options:
+            tasks.append(('overview %s %s' % (color_column, display),
+                          lambda c=color_column, d=display: build_overview_figure(c, d, False, False, (), None)))
+        tasks.append(('2d ' + color_column, lambda c=color_column: build_2d_figure(
+            c, None, x_dropdown.value, y_dropdown.value, (), False, None, DEFAULT_2D_MODE)))
+    for pdb_value in [None, ['VHL_B_H_C']]:
+        for vizu_type in vizua_type_3d.options:
+            tasks.append(('structure %s %s' % (pdb_value, vizu_type), lambda p=pdb_value, v=vizu_type: build_structure_view(
+                structure_file_name(p), v, (), DEFAULT_RESIDUE_FILTER, residue_statistic.value, DEFAULT_LOD)))
+        tasks.append(('structure index %s' % pdb_value, lambda p=pdb_value: get_structure_index(structure_file_name(p))))
+    for view in HEATMAP_VIEWS:
+        for color_blind in (False, True):
+            tasks.append(('heatmap %s %s' % (view, color_blind),
+                          lambda v=view, c=color_blind: build_substitution_heatmap(v, c)))
+    return tasks
+
+
+start_warmup(warmup_state, warmup_tasks())
+
+
+# Dataset hot reload ----------------------------------------------------------------------------------------------------
+def build_indexes(table):
+    """Filter engine and lookup of a table with all their indexes built, see swap_dataset"""
+    index, lookup = VariantIndex(table), VariantLookup(table)
+    for column in FILTER_RANGE_COLUMNS + FILTER_THRESHOLD_COLUMNS + OVERVIEW_AXIS_COLUMNS:
+        index.sorted_index(column)
+    for column in FILTER_CATEGORY_COLUMNS:
+        index.category_bitmap(column, ())
+    for key in LOOKUP_KEYS:
+        lookup.index(key)
+    return index, lookup
+
+
+def swap_dataset(new_df, changed):
+    """
+    Install a new version of the variant table (see dataset_reload.py). The values derived from it at start-up and
+    the indexes of the changed columns are computed first, off the request path, then the table, these values and the
+    new generations of the changed columns are published in one step. The figures are warmed up again afterwards.
+    """
+    register_category_colors(new_df)
+    export_columns = [c for c in new_df.columns if not c.startswith('Unnamed')]
+    bounds, categories = filter_bounds(new_df), filter_categories(new_df)
+    highlight_options = variant_first_search_dropdown(list_var_to_display_first, new_df)
+    index, lookup = build_indexes(new_df)
+    prebuilt = [(cache, value) for cache, value in [(get_variant_index, index), (get_variant_lookup, lookup)]
+                if ALL_COLUMNS in changed or set(cache.columns) & set(changed)]
+
+    def publish():
+        global df, EXPORT_COLUMNS
+        df, EXPORT_COLUMNS = new_df, export_columns
+        FILTER_BOUNDS.update(bounds)
+        FILTER_CATEGORIES.update(categories)
+        reset_filter_controls()
+        variant_highlight_dropd.options = highlight_options
+
+    invalidated = invalidate_columns(changed, publish, prebuilt)
+    run_warmup(WarmupState(), warmup_tasks())
+    return invalidated
+
+
+dataset_reloader = DatasetReloader(DATA_PATH, load_annotated_table, swap_dataset)
+# annotation updates are merged into the current table, the reloaded table merges them at load
+annotation_reloader = AnnotationReloader(ANNOTATION_PATH, swap_dataset, get_variant_lookup) if ANNOTATION_PATH else None
+# the polling threads are started by the first request of each worker
+server.before_request(lambda: dataset_reloader.start(lambda: df))
+if annotation_reloader:
+    server.before_request(lambda: annotation_reloader.start(lambda: df))
 
 # Run app
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+"""
+    Callback cascade tracer
+    Records every /_dash-update-component request with its timing and groups the requests fired for one user action
+    (a click, a dropdown change...) into a cascade.
+
+    Enable it with the environment variable VHL_TRACE_CALLBACKS=<path of a JSON lines file>.
+    Summarise a trace with :  python callback_trace.py trace.jsonl
+"""
+
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request
+
+TRACE_PATH = os.environ.get('VHL_TRACE_CALLBACKS')
+# a request reaching the server more than CASCADE_IDLE seconds after the previous one of the cascade starts a new one
+CASCADE_IDLE = 2.0
+
+
+def _split_outputs(output):
+    if output.startswith('..'):
+        return output[2:-2].split('...')
+    return [output]
+
+
+class CallbackTracer:
+    """Group the callback requests of each client into cascades and append one JSON line per request"""
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self.lock = threading.Lock()
+        self.cascade_ids = itertools.count(1)
+        self.open_cascades = OrderedDict()  # client key -> [cascade id, root trigger, time of last request, step]
+        self._callback_outputs = None
+
+    @property
+    def callback_outputs(self):
+        if self._callback_outputs is None:
+            # outputs declared with allow_duplicate carry a '@<hash>' suffix
+            self._callback_outputs = {output.split('@')[0] for key in self.app.callback_map
+                                      for output in _split_outputs(key)}
+        return self._callback_outputs
+
+    def _cascade(self, client, changed, now):
+        """Return (cascade id, root trigger, step) of the request, opening a new cascade for a user action"""
+        user_action = [prop for prop in changed if prop not in self.callback_outputs]
+        with self.lock:
+            cascade = self.open_cascades.get(client)
+            expired = cascade is None or now - cascade[2] > CASCADE_IDLE
+            page_load = not changed and (expired or cascade[1] != 'page load')
+            if expired or user_action and cascade[1] != user_action or page_load:
+                cascade = [next(self.cascade_ids), user_action or changed or 'page load', now, 0]
+                self.open_cascades[client] = cascade
+                self.open_cascades.move_to_end(client)
+                while len(self.open_cascades) > 1000:
+                    self.open_cascades.popitem(last=False)
+            cascade[2] = now
+            cascade[3] += 1
+            return cascade[0], cascade[1], cascade[3]
+
+    def before_request(self):
+        if not request.path.endswith('/_dash-update-component'):
+            return
+        g.trace_start = time.perf_counter()
+
+    def after_request(self, response):
+        if 'trace_start' not in g:
+            return response
+        duration = time.perf_counter() - g.trace_start
+        body = request.get_json(silent=True) or {}
+        changed = body.get('changedPropIds', [])
+        client = request.headers.get('X-VHL-Action') or '%s %s' % (request.remote_addr, request.user_agent)
+        cascade_id, root, step = self._cascade(client, changed, time.time())
+        record = {'pid': os.getpid(), 'cascade': cascade_id, 'action': request.headers.get('X-VHL-Action'),
+                  'root': root, 'step': step, 'callback': body.get('output'), 'trigger': changed,
+                  'start': time.time() - duration, 'ms': round(duration * 1000, 2), 'status': response.status_code,
+                  'bytes_in': request.content_length, 'bytes_out': response.calculate_content_length()}
+        with self.lock, open(self.path, 'a') as handle:
+            handle.write(json.dumps(record) + '\n')
+        return response
+
+
+def install_callback_tracer(app, path=TRACE_PATH):
+    """Register the tracer on the flask server of a dash app, does nothing when no trace path is configured"""
+    if not path:
+        return None
+    tracer = CallbackTracer(app, path)
+    app.server.before_request(tracer.before_request)
+    app.server.after_request(tracer.after_request)
+    return tracer
+
+
+def summarise_trace(path):
+    """Print, for every cascade, its callbacks in order with the server time they took"""
+    cascades = OrderedDict()
+    with open(path) as handle:
+        for line in handle:
+            record = json.loads(line)
+            key = record['action'] or (record['pid'], record['cascade'])
+            cascades.setdefault(key, []).append(record)
+    for key, records in cascades.items():
+        records.sort(key=lambda r: r['start'])
+        wall = (records[-1]['start'] + records[-1]['ms'] / 1000 - records[0]['start']) * 1000
+        print('cascade %s  trigger=%s  requests=%d  server=%.1f ms  wall=%.1f ms' % (
+            key, records[0]['root'], len(records), sum(r['ms'] for r in records), wall))
+        for record in records:
+            print('    +%8.1f ms %8.1f ms  %-60s <- %s' % ((record['start'] - records[0]['start']) * 1000,
+                                                          record['ms'], record['callback'], ', '.join(record['trigger'])))
+
+
+if __name__ == '__main__':
+    summarise_trace(sys.argv[1])
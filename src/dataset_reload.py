@@ -0,0 +1,190 @@
+"""
+    Hot reload of the variant table
+    - column_cache: lru_cache tagged with the columns of the table a function reads. Its entries are keyed by the
+      generation of these columns, so that a new dataset only invalidates the caches of the columns that changed
+      (a ClinVar update does not recompute the 3D styles).
+    - DatasetReloader: background thread polling the version of the table source (mtime and size of a file, ETag or
+      Last-Modified of a URL), loading and diffing a new version off the request path, then handing it over to a swap
+      function of the app. The app prepares everything derived from the new table first, then installs the table and
+      bumps the generations in one step under the lock of the generations (invalidate_columns), so that no request
+      reads the new table with the cache entries of the old one.
+
+    VHL_DATA_RELOAD_INTERVAL=<seconds> enables the polling (disabled by default).
+"""
+
+import functools
+import os
+import threading
+import time
+import traceback
+import urllib.request
+from functools import lru_cache
+
+RELOAD_INTERVAL = float(os.environ.get('VHL_DATA_RELOAD_INTERVAL', 0))
+ALL_COLUMNS = '*'
+
+
+class ColumnGenerations:
+    """Generation number of every column of the table, bumped when the column changes"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.generations = {}
+        self.table_generation = 0
+
+    def key(self, columns):
+        with self.lock:
+            return (self.table_generation,) + tuple(self.generations.get(column, 0) for column in columns)
+
+    def bump(self, columns):
+        with self.lock:
+            if ALL_COLUMNS in columns:
+                self.table_generation += 1
+            for column in columns:
+                self.generations[column] = self.generations.get(column, 0) + 1
+
+
+generations = ColumnGenerations()
+cache_registry = []
+_swap_lock = threading.Lock()
+
+
+def column_cache(columns, maxsize=128):
+    """
+    lru_cache of a function of the table reading `columns`, invalidated when one of them changes.
+    A change of the rows (order, number) invalidates every column_cache.
+    """
+
+    def decorator(function):
+        primed = {}
+
+        def compute(generation, *args, **kwargs):
+            if (generation, args) in primed:
+                return primed.pop((generation, args))
+            return function(*args, **kwargs)
+
+        cached = lru_cache(maxsize=maxsize)(compute)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return cached(generations.key(columns), *args, **kwargs)
+
+        def prime(value, *args):
+            """Use value, computed beforehand, as the result of the call with args for the current generations"""
+            generation = generations.key(columns)
+            for key in [key for key in primed if key[0] != generation]:
+                del primed[key]
+            primed[(generation, args)] = value
+
+        wrapper.columns = tuple(columns)
+        wrapper.prime = prime
+        wrapper.cache_info = cached.cache_info
+        wrapper.cache_clear = cached.cache_clear
+        cache_registry.append(wrapper)
+        return wrapper
+
+    return decorator
+
+
+def invalidate_columns(changed, publish=None, prebuilt=()):
+    """
+    Bump the generation of the changed columns and free the entries of the caches reading them
+    @param publish
+    function installing the new table, called with the bump under the lock of the generations: a cache key is read
+    either before both or after both
+    @param prebuilt
+    (cache, value) pairs, the results of argument-less caches for the new table, built off the request path
+    """
+    stale = [cache for cache in cache_registry if ALL_COLUMNS in changed or set(cache.columns) & set(changed)]
+    with generations.lock:
+        if publish is not None:
+            publish()
+        generations.bump(changed)
+        # cleared before any request can fill the new generations
+        for cache in stale:
+            cache.cache_clear()
+        for cache, value in prebuilt:
+            cache.prime(value)
+    return [cache.__name__ for cache in stale]
+
+
+def changed_columns(old, new):
+    """Columns whose values differ between two versions of the table, ALL_COLUMNS too if the rows differ"""
+    same_rows = len(old) == len(new) and (old['variant_id'].to_numpy() == new['variant_id'].to_numpy()).all()
+    if not same_rows:
+        return {ALL_COLUMNS} | set(old.columns) | set(new.columns)
+    changed = set(old.columns) ^ set(new.columns)
+    for column in set(old.columns) & set(new.columns):
+        if old[column].dtype != new[column].dtype or not old[column].equals(new[column]):
+            changed.add(column)
+    return changed
+
+
+def source_version(path):
+    """Version stamp of the table source, None when it cannot be read"""
+    try:
+        if '://' not in path:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        with urllib.request.urlopen(urllib.request.Request(path, method='HEAD'), timeout=30) as response:
+            return (response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                    response.headers.get('Content-Length'))
+    except OSError:
+        return None
+
+
+class DatasetReloader:
+    """
+    Poll the source of the table every `interval` seconds and reload it when its version changes
+    @param load
+    function(path) returning the table
+    @param swap
+    function(new table, changed columns) installing the new table in the app and invalidating its caches
+    """
+
+    def __init__(self, path, load, swap, interval=RELOAD_INTERVAL):
+        self.path = path
+        self.load = load
+        self.swap = swap
+        self.interval = interval
+        self.version = source_version(path) if interval > 0 else None
+        self.pid = None
+        self.last_reload = None
+
+    def update(self, current):
+        """(new table, changed columns, details of the update) of the source"""
+        new = self.load(self.path)
+        return new, changed_columns(current(), new), {}
+
+    def reload(self, current):
+        """Load the source, return the changed columns after swapping it in, an empty set when nothing changed"""
+        version = source_version(self.path)
+        if version is None or version == self.version:
+            return set()
+        start = time.perf_counter()
+        # the reloaders of a process take turns, each one updating the table swapped in by the previous one
+        with _swap_lock:
+            new, changed, details = self.update(current)
+            self.version = version
+            if changed:
+                invalidated = self.swap(new, changed)
+                self.last_reload = dict(details, time=time.time(), seconds=round(time.perf_counter() - start, 3),
+                                        changed_columns=sorted(changed), invalidated_caches=invalidated)
+                print('Reloaded %s in %.2f s, changed columns: %s' % (self.path, self.last_reload['seconds'],
+                                                                     ', '.join(sorted(changed))), flush=True)
+        return changed
+
+    def run(self, current):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload(current)
+            except Exception:
+                traceback.print_exc()
+
+    def start(self, current):
+        """Start the polling thread of this process, once (call it from each worker, threads do not survive fork)"""
+        if self.interval <= 0 or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self.run, args=(current,), name='vhl-dataset-reload', daemon=True).start()
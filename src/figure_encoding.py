@@ -0,0 +1,50 @@
+# Compact serialisation of the numeric arrays carried by the plotly figures returned to the browser
+import os
+
+import numpy as np
+
+# Number of decimals kept for float arrays (x, y, customdata...). Plotly.js bundled with dash 2.14 (v2.25) predates
+# base64 typed arrays, so the payload is reduced by sending shorter JSON numbers instead of full float64 text.
+FIGURE_PRECISION = int(os.environ.get('VHL_FIGURE_PRECISION', 4))
+
+DATA_ARRAY_ATTRIBUTES = ('x', 'y', 'z', 'customdata')
+
+
+def round_array(values, precision=FIGURE_PRECISION):
+    """Round a float array, leave the other arrays untouched (see round_columns for the object customdata arrays)"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return np.round(values, precision)
+    return values
+
+
+def round_columns(data, precision=FIGURE_PRECISION):
+    """
+    Copy of a DataFrame with its float columns rounded, to build the customdata of a trace: the rounding is vectorized
+    per column before the mixed columns are turned into an object array that compact_figure does not scan.
+    Rounded in float64, since float32 values would be sent with their binary noise.
+    """
+    if precision is None:
+        return data
+    floats = data.select_dtypes('floating').columns
+    return data.astype({column: float for column in floats}).round({column: precision for column in floats})
+
+
+def compact_figure(fig, precision=FIGURE_PRECISION):
+    """Round in place every numeric data array of a figure and return it.
+    @param fig
+    A plotly go.Figure
+    @param precision
+    Number of decimals kept, None to leave the figure at full precision.
+    """
+    if precision is None:
+        return fig
+    for trace in fig.data:
+        for attribute in DATA_ARRAY_ATTRIBUTES:
+            if attribute not in trace:
+                continue
+            values = trace[attribute]
+            if values is None or isinstance(values, str) or np.ndim(values) == 0 or len(values) == 0:
+                continue
+            trace[attribute] = round_array(values, precision)
+    return fig
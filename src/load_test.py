@@ -0,0 +1,402 @@
+"""
+    Load test of the dashboard against a local gunicorn instance of app:server
+    Replays interaction sessions against the /_dash-update-component endpoint and reports the throughput and the
+    p50/p95/p99 latency of every callback for each (workers, threads) configuration.
+
+    Usage (from the src folder) :
+        python load_test.py --workers 1 2 4 --threads 1 4 --clients 8 --duration 30
+        python load_test.py --url http://127.0.0.1:8050 --clients 4          # against an already running server
+        python load_test.py --sessions recorded_sessions.json                # replay recorded sessions
+
+    A recorded session file is a JSON list of {"name": ..., "steps": [{"component_id.property": value, ...}, ...]}.
+    Every step is applied to the client state and the callbacks it triggers are fired in cascade, like the browser
+    would do (one request at a time per client).
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+# local copies of the data served to the gunicorn started by the load test
+LOCAL_DATA_PATH = os.path.join('assets', 'input', 'vhl_preprocess_df.csv')
+LOCAL_STRUCTURE_DIR = os.path.join('assets', 'input', '3d_structure')
+
+
+# SESSIONS ------------------------------------------------------------------------------------------------------------
+# Built-in sessions. A step is either a dict of changed props or a function(state, rng) returning that dict, so the
+# variant ids, residues and box ranges are taken from what the server actually sent to the client.
+
+def _variant_ids(state, rng, k):
+    options = state.get('variant_highlight_dropd.options') or []
+    return [option['value'] for option in rng.sample(options, min(k, len(options)))]
+
+
+def _vhl_atom_ids(state, rng, k):
+    atoms = (state.get('dashbio-default-molecule3d.modelData') or {}).get('atoms', [])
+    vhl_atoms = [i for i, atom in enumerate(atoms) if atom['chain'] == 'V']
+    return rng.sample(vhl_atoms, min(k, len(vhl_atoms)))
+
+
+def _box_selection(state, rng):
+    """Build the selectedData plotly.js would send for a box drawn over a random slice of the overview graph"""
+    figure = state.get('overview_graph.figure') or {}
+    traces = [trace for trace in figure.get('data', []) if trace.get('customdata') is not None]
+    xs = sorted(x for trace in traces for x in trace['x'] if x is not None)
+    if not xs:
+        return {'overview_graph.selectedData': {'points': []}}
+    start = rng.randrange(len(xs))
+    x_range = [xs[start], xs[min(len(xs) - 1, start + rng.randrange(10, max(11, len(xs) // 3)))]]
+    y_range = [-5, 2]
+    points = []
+    for curve_number, trace in enumerate(figure['data']):
+        for point_index, (x, y) in enumerate(zip(trace['x'], trace['y'])):
+            if x is None or y is None or not (x_range[0] <= x <= x_range[1] and y_range[0] <= y <= y_range[1]):
+                continue
+            point = {'curveNumber': curve_number, 'pointNumber': point_index, 'pointIndex': point_index, 'x': x, 'y': y}
+            if trace.get('customdata') is not None:
+                point['customdata'] = trace['customdata'][point_index]
+            points.append(point)
+    return {'overview_graph.selectedData': {'points': points, 'range': {'x': x_range, 'y': y_range}}}
+
+
+def _heatmap_click(state, rng):
+    """clickData of a random non empty cell of the substitution heatmap"""
+    figure = state.get('heatmap_graph.figure') or {}
+    if not figure.get('data'):
+        return {'heatmap_graph.clickData': None}
+    heatmap = figure['data'][0]
+    cells = [(i, j) for i, row in enumerate(heatmap['z']) for j, z in enumerate(row) if z is not None]
+    i, j = rng.choice(cells)
+    return {'heatmap_graph.clickData': {'points': [{'curveNumber': 0, 'x': heatmap['x'][j], 'y': heatmap['y'][i],
+                                                    'z': heatmap['z'][i][j]}]}}
+
+
+SESSIONS = {
+    'highlight_variants': [
+        lambda state, rng: {'variant_highlight_dropd.value': _variant_ids(state, rng, 1)},
+        lambda state, rng: {'variant_highlight_dropd.value': _variant_ids(state, rng, 5)},
+        {'variant_highlight_dropd.value': []},
+    ],
+    'click_residues': [
+        lambda state, rng: {'dashbio-default-molecule3d.selectedAtomIds': _vhl_atom_ids(state, rng, 1)},
+        lambda state, rng: {'dashbio-default-molecule3d.selectedAtomIds': _vhl_atom_ids(state, rng, 1)},
+        {'vizua_type_3d.value': 'stick'},
+        lambda state, rng: {'dashbio-default-molecule3d.selectedAtomIds': _vhl_atom_ids(state, rng, 1)},
+    ],
+    'switch_pdb': [
+        {'pdb-selector.value': ['VHL_B_H_C']},
+        {'vizua_type_3d.value': 'cartoon'},
+        {'pdb-selector.value': []},
+    ],
+    'box_select_overview': [
+        _box_selection,
+        {'y_dropdown.value': 'REVEL'},
+        _box_selection,
+        {'overview_graph.selectedData': None},
+    ],
+    'color_blind': [
+        {'color_blind_option.on': True},
+        {'overview_dropdown.value': 'tier_class'},
+        {'at_scale.on': True},
+        {'color_blind_option.on': False},
+    ],
+    'filters': [
+        {'filter-cadd-phred.value': 20},
+        {'filter-consequence.value': ['Missense', 'Stop gained']},
+        lambda state, rng: {'variant_highlight_dropd.value': _variant_ids(state, rng, 5)},
+        {'filter-function-score-final.value': [-2, 0.6]},
+    ],
+    'heatmap_cells': [
+        _heatmap_click,
+        {'heatmap_display.value': 'genomic'},
+        _heatmap_click,
+    ],
+    'density_2d': [
+        {'two-d-mode.value': 'density'},
+        lambda state, rng: {'variant_highlight_dropd.value': _variant_ids(state, rng, 3)},
+        {'x_dropdown.value': 'rna_score'},
+        {'two-d-mode.value': 'auto'},
+    ],
+}
+
+
+def load_recorded_sessions(path):
+    with open(path) as handle:
+        return {session['name']: session['steps'] for session in json.load(handle)}
+
+
+# CLIENT --------------------------------------------------------------------------------------------------------------
+# Python equivalent of the clientside callbacks, keyed by their output, so that the cascade reaching the server is the
+# same as in a browser.
+def _reduce_overview_selection(selected_data, at_scale, display):
+    if not selected_data:
+        return None
+    selection_range = selected_data.get('range') or {}
+    if selection_range.get('x') and selection_range.get('y'):
+        return {'range': {'x': selection_range['x'], 'y': selection_range['y']}, 'at_scale': at_scale,
+                'display': display}
+    return {'variant_ids': [point['customdata'][0] for point in selected_data.get('points', []) if 'customdata' in point]}
+
+
+# columns of the filter controls, in the order of the inputs of the clientside callback filling variant-filter
+FILTER_COLUMNS = ['function_score_final', 'rna_score', 'CADD.phred', 'REVEL', 'VARITY_R', 'max_spliceAI', 'consequence',
+                  'clinvar_simple', 'tier_class']
+
+CLIENTSIDE_CALLBACKS = {'overview-selection.data': _reduce_overview_selection,
+                        'variant-filter.data': lambda *values: dict(zip(FILTER_COLUMNS, values)),
+                        'export-query.value': lambda *values: json.dumps(list(values))}
+
+
+def _walk_layout(node, state):
+    if isinstance(node, list):
+        for child in node:
+            _walk_layout(child, state)
+    elif isinstance(node, dict) and 'props' in node:
+        props = node['props']
+        if 'id' in props and isinstance(props['id'], str):
+            for prop, value in props.items():
+                if prop != 'children' or not isinstance(value, (dict, list)):
+                    state[props['id'] + '.' + prop] = value
+        _walk_layout(props.get('children'), state)
+
+
+def _split_outputs(output):
+    if output.startswith('..'):
+        return output[2:-2].split('...')
+    return [output]
+
+
+def _clean_output(output):
+    # outputs declared with allow_duplicate carry a '@<hash>' suffix
+    return output.split('@')[0]
+
+
+class DashSessionClient:
+    """Minimal dash renderer: keeps the props of the page and fires the callbacks triggered by every change"""
+
+    def __init__(self, base_url, layout, dependencies, record, action_id_prefix=''):
+        self.base_url = base_url.rstrip('/')
+        self.record = record
+        self.dependencies = dependencies
+        self.state = {}
+        _walk_layout(layout, self.state)
+        self.action_id_prefix = action_id_prefix
+        self.action_count = 0
+
+    def _post(self, payload, action_id):
+        request = urllib.request.Request(self.base_url + '/_dash-update-component', data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json', 'X-VHL-Action': action_id})
+        with urllib.request.urlopen(request, timeout=120) as response:
+            body = response.read()
+            return response.status, json.loads(body) if body else None
+
+    def _payload(self, callback, changed):
+        outputs = []
+        for output in _split_outputs(callback['output']):
+            component_id, prop = output.rsplit('.', 1)
+            outputs.append({'id': component_id, 'property': prop})
+        inputs = [{'id': i['id'], 'property': i['property'], 'value': self.state.get(i['id'] + '.' + i['property'])}
+                  for i in callback['inputs']]
+        changed = [i['id'] + '.' + i['property'] for i in callback['inputs'] if i['id'] + '.' + i['property'] in changed]
+        state = [{'id': s['id'], 'property': s['property'], 'value': self.state.get(s['id'] + '.' + s['property'])}
+                 for s in callback['state']]
+        return {'output': callback['output'], 'outputs': outputs if callback['output'].startswith('..') else outputs[0],
+                'inputs': inputs, 'changedPropIds': changed, 'state': state}
+
+    def _triggered_by(self, changed):
+        return [callback for callback in self.dependencies
+                if any(i['id'] + '.' + i['property'] in changed for i in callback['inputs'])]
+
+    def _run_callback(self, callback, changed, action_id):
+        """Fire one callback and return the set of props it changed"""
+        outputs = _split_outputs(callback['output'])
+        if callback.get('clientside_function') is not None or callback['output'] in CLIENTSIDE_CALLBACKS:
+            function = CLIENTSIDE_CALLBACKS.get(callback['output'])
+            if function is None:
+                return set()
+            values = function(*[self.state.get(i['id'] + '.' + i['property'])
+                                for i in callback['inputs'] + callback['state']])
+            outputs = [_clean_output(output) for output in outputs]
+            self.state.update(zip(outputs, values if len(outputs) > 1 else [values]))
+            return set(outputs)
+        start = time.perf_counter()
+        try:
+            status, body = self._post(self._payload(callback, changed), action_id)
+        except (urllib.error.URLError, socket.timeout, ConnectionError) as error:
+            self.record(outputs[0], time.perf_counter() - start, error)
+            return set()
+        self.record(outputs[0], time.perf_counter() - start, None)
+        if status == 204 or body is None:
+            return set()
+        new_changed = set()
+        for component_id, props in body.get('response', {}).items():
+            for prop, value in props.items():
+                self.state[component_id + '.' + prop] = value
+                new_changed.add(component_id + '.' + prop)
+        return new_changed
+
+    def fire(self, changed=None):
+        """Fire, in cascade, every callback whose inputs are in `changed`. `changed` None means page load."""
+        self.action_count += 1
+        action_id = '%s%d' % (self.action_id_prefix, self.action_count)
+        if changed is None:
+            changed = set()
+            pending = [callback for callback in self.dependencies if not callback.get('prevent_initial_call')]
+        else:
+            changed = set(changed)
+            pending = self._triggered_by(changed)
+        fired = set()
+        while pending:
+            pending_outputs = {_clean_output(output) for callback in pending
+                               for output in _split_outputs(callback['output'])}
+            # like the renderer, wait for the callbacks producing one of the inputs
+            ready = [callback for callback in pending
+                     if not any(i['id'] + '.' + i['property'] in pending_outputs for i in callback['inputs'])]
+            callback = (ready or pending)[0]
+            pending.remove(callback)
+            fired.add(callback['output'])
+            new_changed = self._run_callback(callback, changed, action_id)
+            changed |= new_changed
+            pending += [triggered for triggered in self._triggered_by(new_changed)
+                        if triggered['output'] not in fired and triggered not in pending]
+
+    def apply(self, step, rng):
+        changes = step(self.state, rng) if callable(step) else step
+        self.state.update(changes)
+        self.fire(changes.keys())
+
+
+# RUNNER --------------------------------------------------------------------------------------------------------------
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+
+    def record(self, label, seconds, error):
+        with self.lock:
+            if error is not None:
+                self.errors += 1
+            else:
+                self.latencies.setdefault(label, []).append(seconds)
+
+
+def _get_json(url):
+    with urllib.request.urlopen(url, timeout=120) as response:
+        return json.loads(response.read())
+
+
+def run_clients(base_url, sessions, n_clients, duration, think_time, seed=0):
+    layout = _get_json(base_url + '/_dash-layout')
+    dependencies = _get_json(base_url + '/_dash-dependencies')
+    stats = Stats()
+    deadline = time.perf_counter() + duration
+
+    def client_loop(client_index):
+        rng = random.Random(seed + client_index)
+        while time.perf_counter() < deadline:
+            name = rng.choice(sorted(sessions))
+            client = DashSessionClient(base_url, layout, dependencies, stats.record,
+                                       action_id_prefix='%d-%s-' % (client_index, name))
+            client.fire()
+            for step in sessions[name]:
+                if time.perf_counter() >= deadline:
+                    break
+                client.apply(step, rng)
+                time.sleep(think_time)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))]
+
+
+def print_report(title, stats, elapsed):
+    n_requests = sum(len(v) for v in stats.latencies.values())
+    print('\n' + title)
+    print('%d requests in %.1f s: %.1f req/s, %d errors' % (n_requests, elapsed, n_requests / elapsed, stats.errors))
+    print('%-45s %7s %9s %9s %9s %9s' % ('callback', 'n', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for label, values in sorted(stats.latencies.items()):
+        print('%-45s %7d %9.1f %9.1f %9.1f %9.1f' % (label, len(values), statistics.mean(values) * 1000,
+                                                     _percentile(values, 50) * 1000, _percentile(values, 95) * 1000,
+                                                     _percentile(values, 99) * 1000))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, port, timeout=300):
+    command = [sys.executable, '-m', 'gunicorn', '--preload', '--chdir', SRC_DIR, 'app:server',
+               '--bind', '127.0.0.1:%d' % port,
+               '--workers', str(workers), '--threads', str(threads), '--timeout', '120']
+    # the server reads the variant table and the structures of the checkout, no outside service is needed
+    env = dict(os.environ, VHL_DATA_PATH=os.path.join(SRC_DIR, LOCAL_DATA_PATH),
+               VHL_STRUCTURE_DIR=os.path.join(SRC_DIR, LOCAL_STRUCTURE_DIR))
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with code %s' % process.returncode)
+        try:
+            urllib.request.urlopen('http://127.0.0.1:%d/ready' % port, timeout=5)
+            return process
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('gunicorn did not answer within %d s' % timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--clients', type=int, default=8, help='number of concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load per configuration')
+    parser.add_argument('--think-time', type=float, default=0, help='pause in seconds between two user actions')
+    parser.add_argument('--sessions', help='JSON file of recorded sessions replacing the built-in ones')
+    parser.add_argument('--url', help='target an already running server instead of starting gunicorn')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sessions = load_recorded_sessions(args.sessions) if args.sessions else SESSIONS
+    if args.url:
+        stats, elapsed = run_clients(args.url, sessions, args.clients, args.duration, args.think_time, args.seed)
+        print_report('%s clients=%d' % (args.url, args.clients), stats, elapsed)
+        return
+
+    for workers in args.workers:
+        for threads in args.threads:
+            port = _free_port()
+            process = start_gunicorn(workers, threads, port)
+            try:
+                stats, elapsed = run_clients('http://127.0.0.1:%d' % port, sessions, args.clients, args.duration,
+                                             args.think_time, args.seed)
+            finally:
+                process.terminate()
+                process.wait()
+            print_report('workers=%d threads=%d clients=%d' % (workers, threads, args.clients), stats, elapsed)
+
+
+if __name__ == '__main__':
+    main()
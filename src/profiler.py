@@ -0,0 +1,136 @@
+"""
+    On-demand profiler of the callbacks and figure builders
+    Functions decorated with @profiled(name) write one profile per call to VHL_PROFILE_DIR, in a format read by the
+    flame-graph tools:
+    - VHL_PROFILE_MODE=sample (default): stacks sampled every VHL_PROFILE_SAMPLE_MS ms, written as folded stacks
+      (<name>-<time>-<pid>.folded), to open with speedscope or flamegraph.pl
+    - VHL_PROFILE_MODE=cprofile: deterministic cProfile stats (<name>-<time>-<pid>.prof), to open with snakeviz or
+      flameprof
+
+    VHL_PROFILE=all profiles every call, otherwise only the calls made while serving a request carrying the header
+    X-VHL-Profile. A function is profiled at most once every VHL_PROFILE_INTERVAL seconds (default 10) per process,
+    so that leaving the profiler on costs a few checks per call.
+    Nothing is profiled when VHL_PROFILE_DIR is not set.
+"""
+
+import cProfile
+import functools
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import has_request_context, request
+
+PROFILE_DIR = os.environ.get('VHL_PROFILE_DIR')
+PROFILE_ALL = os.environ.get('VHL_PROFILE') == 'all'
+PROFILE_MODE = os.environ.get('VHL_PROFILE_MODE', 'sample')
+PROFILE_INTERVAL = float(os.environ.get('VHL_PROFILE_INTERVAL', 10))
+SAMPLE_INTERVAL = float(os.environ.get('VHL_PROFILE_SAMPLE_MS', 5)) / 1000
+PROFILE_HEADER = 'X-VHL-Profile'
+
+_lock = threading.Lock()
+_last_profile = {}  # name -> time of the last profile
+_active = threading.local()
+# cProfile can only profile one thread at a time on recent pythons
+_cprofile_lock = threading.Lock()
+
+
+def _requested():
+    if PROFILE_ALL:
+        return True
+    return has_request_context() and bool(request.headers.get(PROFILE_HEADER))
+
+
+def _acquire(name):
+    """True if the call of `name` is to be profiled, and if so starts its rate limiting interval"""
+    if not PROFILE_DIR or getattr(_active, 'profiling', False) or not _requested():
+        return False
+    now = time.monotonic()
+    with _lock:
+        if now - _last_profile.get(name, -PROFILE_INTERVAL) < PROFILE_INTERVAL:
+            return False
+        _last_profile[name] = now
+    return True
+
+
+def _dump_path(name, extension):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    file_name = '%s-%s-%d.%s' % (re.sub(r'[^\w.-]', '_', name), time.strftime('%Y%m%d-%H%M%S'), os.getpid(), extension)
+    return os.path.join(PROFILE_DIR, file_name)
+
+
+class StackSampler(threading.Thread):
+    """Sample the stack of a thread, below a root frame, into folded stacks counts"""
+
+    def __init__(self, thread_id, root_frame, interval=SAMPLE_INTERVAL):
+        super().__init__(name='vhl-profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.root_frame = root_frame
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root_frame:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path, name):
+        with open(path, 'w') as handle:
+            for stack, count in self.stacks.items():
+                handle.write('%s;%s %d\n' % (name, stack, count))
+
+
+def _profile_sampled(name, function, args, kwargs):
+    sampler = StackSampler(threading.get_ident(), sys._getframe())
+    sampler.start()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sampler.stop()
+        sampler.write(_dump_path(name, 'folded'), name)
+
+
+def _profile_cprofile(name, function, args, kwargs):
+    if not _cprofile_lock.acquire(blocking=False):
+        return function(*args, **kwargs)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        _cprofile_lock.release()
+        profile.dump_stats(_dump_path(name, 'prof'))
+
+
+def profiled(name):
+    """Decorator profiling the calls of a function when enabled, see the module docstring"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _acquire(name):
+                return function(*args, **kwargs)
+            _active.profiling = True
+            try:
+                if PROFILE_MODE == 'cprofile':
+                    return _profile_cprofile(name, function, args, kwargs)
+                return _profile_sampled(name, function, args, kwargs)
+            finally:
+                _active.profiling = False
+
+        return wrapper
+
+    return decorator
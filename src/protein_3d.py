@@ -7,6 +7,8 @@ from matplotlib.colors import LinearSegmentedColormap
 
 import time
 
+from profiler import profiled
+
 pd.set_option('display.width', 900)
 pd.set_option('display.max_columns', 200)
 pd.set_option("display.max_rows", None)
@@ -101,8 +103,12 @@ AMINO_ACID_CLASSES = {
 }
 
 
-def create_style_3d(df, colname_score, atoms, visualization_type="stick", color_element="atom", color_scheme=None, hightlight_vars=None):
+@profiled('create_style_3d')
+def create_style_3d(residue_scores, colname_score, atoms, visualization_type="stick", color_element="atom", color_scheme=None, highlight_residues=None, score_range=None):
     """Function to create styles input for Molecule3dViewer
+    @param residue_scores
+    DataFrame indexed by protein position (protPos) holding the per-residue score in colname_score,
+    used when color_element is 'residue_score'.
     @param atoms
     A list of atoms. Each atom should be a dict with keys: 'name', 'residue_name', 'chain'
     @param visualization_type
@@ -112,6 +118,10 @@ def create_style_3d(df, colname_score, atoms, visualization_type="stick", color_
     This should be a dict with keys being names of atoms, residues, residue types or chains,
     depending on the value of color_element argument. If no value is provided, default color
     schemes will be used.
+    @param highlight_residues
+    Protein positions colored in cyan when color_element is 'residue_score'.
+    @param score_range
+    (vmin, vmax) of the colormap. Default to the min and max of the residue scores.
     """
 
     # regular color ----------------------------------------------------------------------------------------------------
@@ -125,16 +135,20 @@ def create_style_3d(df, colname_score, atoms, visualization_type="stick", color_
 
     #cmap = plt.get_cmap('plasma') # inferno', 'plasma', or 'magma
     # Normalize the data to the [0, 1] range for colormap
-    normalize = mcolors.Normalize(vmin=df['average_fs_missense_at_aa_rna'].min(), vmax=df['average_fs_missense_at_aa_rna'].max())
+    scores = residue_scores[colname_score].dropna()
+    if score_range is None:
+        score_range = (scores.min(), scores.max())
+    normalize = mcolors.Normalize(vmin=score_range[0], vmax=score_range[1])
     colormap = plt.cm.ScalarMappable(norm=normalize, cmap=custom_cmap)
-    # Convert the normalized values to HEX codes and add a new column
-    df['color'] = df['average_fs_missense_at_aa_rna'].apply(lambda x: mcolors.to_hex(colormap.to_rgba(x)))
+    # Convert the normalized values to HEX codes, once per residue
+    residue_colors = dict(zip(scores.index.astype(int), [mcolors.to_hex(rgba) for rgba in colormap.to_rgba(scores.to_numpy())]))
 
     # highlight color
-    if hightlight_vars is not None:
+    if highlight_residues is not None:
         highlight_color = '#33FFFF' # cyan
-        df['color'] = df.apply(lambda row: highlight_color if row['variant_id'] in hightlight_vars else row['color'],
-                               axis=1)
+        for position in highlight_residues:
+            if position in residue_colors:
+                residue_colors[position] = highlight_color
 
     if visualization_type not in ['stick', 'cartoon', 'sphere']:
         raise Exception("Invalid argument type: visualization_type. \
@@ -191,20 +205,7 @@ def create_style_3d(df, colname_score, atoms, visualization_type="stick", color_
             if color_element == 'chain':
                 atom_color = color_scheme.get(a['chain'], default_color)
             if color_element == 'residue_score':
-                if a["residue_index"]+60 in list(df['protPos']):
-                    subset_df = df.loc[
-                        (df['protPos'] == a['residue_index']+60) & (~df['average_fs_missense_at_aa_rna'].isna())]
-                    subset_df = subset_df.sort_values(colname_score, ascending=False)
-                    if subset_df.empty:
-                        atom_color = default_color
-                    else:
-                        # if cyan in one of the variant, color in cyan else color in average
-                        if '#33FFFF' in list(subset_df['color']):
-                            atom_color = '#33FFFF'
-                        else:
-                            atom_color = subset_df['color'].to_list()[0]
-                else:
-                    atom_color = default_color
+                atom_color = residue_colors.get(a["residue_index"] + 60, default_color)
             else:
                 atom_color = color_scheme.get(a['name'], default_color)
         atom_styles.append({
@@ -215,4 +216,52 @@ def create_style_3d(df, colname_score, atoms, visualization_type="stick", color_
 
     # Print time elapsed
     #print("Time Elapsed: {:.2f} seconds".format(end_time - start_time))
-    return atom_styles
\ No newline at end of file
+    return atom_styles
+
+
+LOD_ATOM_NAMES = {
+    'backbone': ('N', 'CA', 'C', 'O'),
+    'trace': ('CA',),
+}
+
+
+def reduce_model(data, level, keep_chains=(), keep_residues=()):
+    """Function to create a level-of-detail copy of a Molecule3dViewer model
+    @param data
+    A dict with keys 'atoms' and 'bonds' as returned by PdbParser.mol3d_data().
+    @param level
+    'backbone' (N, CA, C, O) | 'trace' (CA only, consecutive CA bonded).
+    @param keep_chains
+    Chains kept with all their atoms.
+    @param keep_residues
+    (chain, residue_index) pairs kept with all their atoms.
+    Atoms are renumbered: the viewer expects atom['serial'] to be the position of the atom in the list.
+    """
+    if level not in LOD_ATOM_NAMES:
+        raise Exception("Invalid argument type: level. Should be: 'backbone' | 'trace'.")
+    atom_names = LOD_ATOM_NAMES[level]
+    keep_residues = set(keep_residues)
+
+    new_index = {}
+    atoms = []
+    for i, a in enumerate(data['atoms']):
+        if a['chain'] in keep_chains or a['name'] in atom_names or (a['chain'], a['residue_index']) in keep_residues:
+            new_index[i] = len(atoms)
+            atoms.append(dict(a, serial=len(atoms)))
+
+    bonds = [dict(b, atom1_index=new_index[b['atom1_index']], atom2_index=new_index[b['atom2_index']])
+             for b in data['bonds'] if b['atom1_index'] in new_index and b['atom2_index'] in new_index]
+
+    if level == 'trace':
+        # join consecutive CA of a chain so the trace is drawn as a continuous line
+        bonded = {(b['atom1_index'], b['atom2_index']) for b in bonds}
+        previous = None
+        for a in atoms:
+            if a['name'] != 'CA' or a['chain'] in keep_chains:
+                continue
+            if previous is not None and previous['chain'] == a['chain'] and \
+                    a['residue_index'] - previous['residue_index'] == 1 and \
+                    (previous['serial'], a['serial']) not in bonded:
+                bonds.append({'atom1_index': previous['serial'], 'atom2_index': a['serial'], 'bond_order': 1})
+            previous = a
+    return {'atoms': atoms, 'bonds': bonds}
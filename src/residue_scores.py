@@ -0,0 +1,61 @@
+# Per-residue aggregation of the variant scores, recomputed from the filters chosen in the app
+import numpy as np
+
+# Filters reproducing the precomputed 'average_fs_missense_at_aa_rna' column
+DEFAULT_RNA_THRESHOLD = -2
+DEFAULT_CONSEQUENCES = ('Missense',)
+RESIDUE_STATISTICS = ('mean', 'min')
+
+
+def residue_filter_key(rna_threshold=DEFAULT_RNA_THRESHOLD, consequences=DEFAULT_CONSEQUENCES, tier_classes=None):
+    """Hashable key of a residue filter, used to cache the masks and aggregates"""
+    return (None if rna_threshold is None else float(rna_threshold),
+            tuple(sorted(consequences)) if consequences is not None else None,
+            tuple(sorted(tier_classes)) if tier_classes is not None else None)
+
+
+def residue_filter_mask(df, rna_threshold=DEFAULT_RNA_THRESHOLD, consequences=DEFAULT_CONSEQUENCES,
+                        tier_classes=None):
+    """
+    Boolean array of the variants entering the per-residue aggregates
+    @param rna_threshold
+    Keep variants with rna_score >= rna_threshold (variants without RNA score are dropped). None to keep all.
+    @param consequences, tier_classes
+    Collections of the consequence / function class to keep. None to keep all.
+    """
+    mask = df['protPos'].notna().to_numpy()
+    if rna_threshold is not None:
+        mask &= (df['rna_score'] >= rna_threshold).to_numpy()
+    if consequences is not None:
+        mask &= df['consequence'].isin(consequences).to_numpy()
+    if tier_classes is not None:
+        mask &= df['tier_class'].isin(tier_classes).to_numpy()
+    return mask
+
+
+def aggregate_residue_scores(df, mask, score_column='function_score_final'):
+    """
+    Mean and min of score_column per protein position (protPos) over the variants in mask, in one groupby
+    """
+    return df.loc[mask].groupby('protPos')[score_column].agg(list(RESIDUE_STATISTICS))
+
+
+def describe_residue_filter(rna_threshold=DEFAULT_RNA_THRESHOLD, consequences=DEFAULT_CONSEQUENCES, tier_classes=None):
+    # e.g. 'missense variants with RNA score ≥ -2'
+    if consequences is None or len(consequences) == 0 or len(consequences) > 2:
+        text = 'variants'
+    else:
+        text = ' or '.join(c.lower() for c in sorted(consequences)) + ' variants'
+    if tier_classes is not None:
+        text += ' of class ' + '/'.join(sorted(tier_classes))
+    if rna_threshold is not None:
+        text += ' with RNA score ≥ ' + ('%g' % rna_threshold)
+    return text
+
+
+def residue_score_range(residue_scores, statistic='mean'):
+    # (vmin, vmax) used by both the 3D coloring and its colorbar
+    if residue_scores.empty or statistic not in residue_scores:
+        return 0.0, 1.0
+    values = residue_scores[statistic].to_numpy(dtype=float)
+    return float(np.nanmin(values)), float(np.nanmax(values))
@@ -0,0 +1,52 @@
+# Spatial index of the atoms of a structure, to select residues by distance without an all-pairs distance scan
+import numpy as np
+from scipy.spatial import cKDTree
+
+VHL_CHAIN = 'V'
+# residue_index of the VHL chain in the 1LM8 files + VHL_RESIDUE_OFFSET = protein position (protPos)
+VHL_RESIDUE_OFFSET = 60
+
+
+class StructureIndex:
+    """
+    KD-trees over the atom coordinates of a structure, one per chain, built once per structure.
+    @param atoms
+    The 'atoms' list of PdbParser.mol3d_data(): dicts with keys 'positions', 'chain' and 'residue_index'.
+    """
+
+    def __init__(self, atoms):
+        self.positions = np.array([a['positions'] for a in atoms], dtype=float)
+        self.chains = np.array([a['chain'] for a in atoms])
+        self.residue_indexes = np.array([a['residue_index'] for a in atoms])
+        self.chain_atoms = {chain: np.flatnonzero(self.chains == chain) for chain in np.unique(self.chains)}
+        self.chain_trees = {chain: cKDTree(self.positions[idx]) for chain, idx in self.chain_atoms.items()}
+
+    def residue_atoms(self, residue_index, chain=VHL_CHAIN):
+        idx = self.chain_atoms.get(chain, np.array([], dtype=int))
+        return idx[self.residue_indexes[idx] == residue_index]
+
+    def residues_near_points(self, points, radius, chain=VHL_CHAIN):
+        """Sorted residue indexes of `chain` with at least one atom within `radius` Å of one of the points"""
+        if chain not in self.chain_trees or len(points) == 0:
+            return np.array([], dtype=int)
+        neighbours = self.chain_trees[chain].query_ball_point(points, r=radius, return_sorted=False)
+        near_atoms = self.chain_atoms[chain][np.unique(np.concatenate([np.asarray(n, dtype=int) for n in neighbours]))]
+        return np.unique(self.residue_indexes[near_atoms])
+
+    def residues_within(self, residue_index, radius, chain=VHL_CHAIN):
+        """Residues of `chain` within `radius` Å of any atom of a residue of the same chain (itself included)"""
+        return self.residues_near_points(self.positions[self.residue_atoms(residue_index, chain)], radius, chain)
+
+    def interface_residues(self, partner_chain, radius, chain=VHL_CHAIN):
+        """Residues of `chain` within `radius` Å of any atom of `partner_chain`"""
+        if partner_chain not in self.chain_trees or chain not in self.chain_trees:
+            return np.array([], dtype=int)
+        # distance of every atom of the chain to the closest partner atom, inf when further than radius
+        distances = self.chain_trees[partner_chain].query(self.positions[self.chain_atoms[chain]], k=1,
+                                                          distance_upper_bound=radius)[0]
+        return np.unique(self.residue_indexes[self.chain_atoms[chain][np.isfinite(distances)]])
+
+
+def to_protein_positions(residue_indexes):
+    # VHL residue indexes of the structure to protPos of the variant table
+    return [int(r) + VHL_RESIDUE_OFFSET for r in residue_indexes]
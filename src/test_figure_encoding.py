@@ -0,0 +1,72 @@
+"""
+    The figures rounded by figure_encoding look the same as the full precision ones: same traces, same categories,
+    and coordinates and hover data equal within 10^-VHL_FIGURE_PRECISION.
+
+    Run from the src folder :  python -m pytest test_figure_encoding.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('VHL_DATA_PATH', os.path.join(SRC_DIR, 'assets', 'input', 'vhl_preprocess_df.csv'))
+os.environ.setdefault('VHL_STRUCTURE_DIR', os.path.join(SRC_DIR, 'assets', 'input', '3d_structure'))
+os.environ.setdefault('VHL_WARMUP', '0')
+
+import app  # noqa: E402
+from figure_encoding import FIGURE_PRECISION  # noqa: E402
+
+HIGHLIGHT = ('3_10141958_G_T', '3_10142138_C_G', '3_10149762_G_A')
+FIGURES = [('overview', (column, display, color_blind, at_scale, HIGHLIGHT, None))
+           for column in app.COLOR_COLUMNS for display in app.overview_display.options
+           for color_blind, at_scale in [(False, False), (True, True)]] + \
+          [('2d', (column, None, x_col, 'CADD.phred', HIGHLIGHT, False, None, 'points'))
+           for column in app.COLOR_COLUMNS for x_col in ['function_score_final', 'rna_score']]
+BUILDERS = {'overview': app.build_overview_figure, '2d': app.build_2d_figure}
+
+
+def build(kind, args, compact, monkeypatch):
+    builder = BUILDERS[kind]
+    builder.cache_clear()
+    with monkeypatch.context() as patch:
+        if not compact:
+            patch.setattr(app, 'compact_figure', lambda fig: fig)
+            patch.setattr(app, 'round_columns', lambda data: data)
+        figure = builder(*args)
+    builder.cache_clear()
+    return figure
+
+
+def assert_close(rounded, full):
+    rounded, full = np.asarray(rounded, dtype=object), np.asarray(full, dtype=object)
+    assert rounded.shape == full.shape
+    for rounded_value, full_value in zip(rounded.ravel(), full.ravel()):
+        if isinstance(full_value, (float, np.floating)) and not np.isnan(full_value):
+            assert abs(rounded_value - full_value) <= 10 ** -FIGURE_PRECISION
+        elif isinstance(full_value, (float, np.floating)):
+            assert np.isnan(rounded_value)
+        else:
+            assert rounded_value == full_value
+
+
+@pytest.mark.parametrize('kind,args', FIGURES)
+def test_rounded_figure_looks_the_same(kind, args, monkeypatch):
+    rounded, full = build(kind, args, True, monkeypatch), build(kind, args, False, monkeypatch)
+    assert [trace.type for trace in rounded.data] == [trace.type for trace in full.data]
+    assert [trace.name for trace in rounded.data] == [trace.name for trace in full.data]
+    for rounded_trace, full_trace in zip(rounded.data, full.data):
+        for attribute in ['x', 'y', 'customdata']:
+            if full_trace[attribute] is None:
+                assert rounded_trace[attribute] is None
+                continue
+            assert len(rounded_trace[attribute]) == len(full_trace[attribute])
+            assert_close(rounded_trace[attribute], full_trace[attribute])
+        if full_trace.marker is not None and full_trace.marker.color is not None:
+            assert np.array_equal(np.asarray(rounded_trace.marker.color), np.asarray(full_trace.marker.color))
+
+
+def test_rounding_reduces_the_payload(monkeypatch):
+    kind, args = FIGURES[0]
+    assert len(build(kind, args, True, monkeypatch).to_json()) < len(build(kind, args, False, monkeypatch).to_json())
@@ -0,0 +1,58 @@
+# Streaming export of a set of rows of the variant table, chunk by chunk, as CSV or Parquet
+import io
+
+EXPORT_CHUNK_ROWS = 2000
+EXPORT_FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+
+def _chunks(rows, chunk_rows):
+    for start in range(0, len(rows), chunk_rows):
+        yield rows[start:start + chunk_rows]
+
+
+def iter_csv(df, rows, columns, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield the CSV text of df.iloc[rows, columns], one chunk of rows at a time"""
+    yield ','.join(columns) + '\n'
+    for chunk in _chunks(rows, chunk_rows):
+        yield df.iloc[chunk][columns].to_csv(header=False, index=False)
+
+
+class _DrainedBuffer(io.RawIOBase):
+    """Write-only file handing over what has been written since the last drain"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+
+def iter_parquet(df, rows, columns, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield the bytes of a Parquet file of df.iloc[rows, columns], one row group per chunk of rows"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(df.iloc[:0][columns], preserve_index=False)
+    # the type of object columns cannot be inferred from an empty frame, they hold strings
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+    sink = _DrainedBuffer()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for chunk in _chunks(rows, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(df.iloc[chunk][columns], schema=schema, preserve_index=False))
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,90 @@
+# Sorted indexes and category bitmaps of the variant table, to resolve range selections and filters without scanning
+# the table
+import numpy as np
+
+
+class SortedIndex:
+    """
+    Row positions of a column sorted by value, built once per column.
+    Missing values are sorted last and never returned by a range query.
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        self.values = values
+        self.order = np.argsort(values, kind='stable')
+        self.sorted_values = values[self.order]
+
+    def range_rows(self, low, high):
+        """Row positions (in value order) of the values in [low, high]"""
+        start = np.searchsorted(self.sorted_values, low, side='left')
+        end = np.searchsorted(self.sorted_values, high, side='right')
+        return self.order[start:end]
+
+
+def box_rows(x_index, x_range, y_values, y_range):
+    """
+    Sorted row positions inside a box: the candidates of the x range are read from the sorted index of x and only
+    they are tested against the y range, so the cost follows the number of rows in the x range.
+    """
+    rows = x_index.range_rows(min(x_range), max(x_range))
+    y = y_values[rows]
+    return np.sort(rows[(y >= min(y_range)) & (y <= max(y_range))])
+
+
+class VariantIndex:
+    """
+    Filter engine of the variant table: sorted indexes of the numeric columns and one bitmap (np.packbits) per
+    category of the categorical columns, built lazily on first use. A filter is matched by combining bitmaps with
+    bitwise operations instead of scanning the table.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.n_rows = len(df)
+        self.sorted_indexes = {}
+        self.category_bitmaps = {}
+
+    def sorted_index(self, column):
+        if column not in self.sorted_indexes:
+            self.sorted_indexes[column] = SortedIndex(self.df[column].to_numpy(dtype=float, na_value=np.nan))
+        return self.sorted_indexes[column]
+
+    def rows_bitmap(self, rows):
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask)
+
+    def range_bitmap(self, column, low, high):
+        """Bitmap of the rows with low <= column <= high, missing values excluded"""
+        return self.rows_bitmap(self.sorted_index(column).range_rows(low, high))
+
+    def category_bitmap(self, column, values):
+        """Bitmap of the rows whose column is one of values"""
+        if column not in self.category_bitmaps:
+            categories = self.df[column].astype('category')
+            codes = categories.cat.codes.to_numpy()
+            self.category_bitmaps[column] = {category: np.packbits(codes == code)
+                                             for code, category in enumerate(categories.cat.categories)}
+        bitmap = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        for value in values:
+            if value in self.category_bitmaps[column]:
+                bitmap |= self.category_bitmaps[column][value]
+        return bitmap
+
+    def filter_bitmap(self, filter_key):
+        """
+        Bitmap of the rows matching every condition of filter_key, a tuple of ('range', column, low, high) and
+        ('in', column, values) conditions
+        """
+        bitmap = np.packbits(np.ones(self.n_rows, dtype=bool))
+        for condition in filter_key:
+            if condition[0] == 'range':
+                bitmap &= self.range_bitmap(*condition[1:])
+            else:
+                bitmap &= self.category_bitmap(*condition[1:])
+        return bitmap
+
+    def rows(self, bitmap):
+        """Sorted row positions of a bitmap"""
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.n_rows))
@@ -0,0 +1,82 @@
+# Hash index lookups of variants by variant_id, cHGVS or (hg38_pos, ref, alt), and the streamed JSON of their scores
+import numpy as np
+import pandas as pd
+
+LOOKUP_CHUNK_ROWS = 2000
+LOOKUP_COLUMNS = ['variant_id', 'cHGVS', 'pHGVS', 'hg38_pos', 'ref', 'alt', 'consequence', 'function_score_final',
+                  'q_value', 'tier_class', 'rna_score', 'clinvar_simple', 'CADD.phred', 'REVEL', 'VARITY_R',
+                  'max_spliceAI']
+# key of the request body -> columns of the variant table it is matched on
+LOOKUP_KEYS = {'variant_ids': ['variant_id'], 'cHGVS': ['cHGVS'], 'positions': ['hg38_pos', 'ref', 'alt']}
+
+
+class VariantLookup:
+    """
+    Hash indexes (pd.Index) of the variant table on each set of LOOKUP_KEYS columns, built lazily on first use.
+    Duplicated keys resolve to their first row.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.indexes = {}
+
+    def index(self, key):
+        if key not in self.indexes:
+            columns = LOOKUP_KEYS[key]
+            if len(columns) == 1:
+                index = pd.Index(self.df[columns[0]].astype(str))
+            else:
+                index = pd.MultiIndex.from_arrays([self.df[c].astype(int) if c == 'hg38_pos' else self.df[c].astype(str)
+                                                   for c in columns])
+            unique = ~index.duplicated()
+            self.indexes[key] = index[unique], np.flatnonzero(unique)
+        return self.indexes[key]
+
+    def rows(self, key, values):
+        """Row positions of values (-1 when absent), values being strings or (hg38_pos, ref, alt) sequences"""
+        index, positions = self.index(key)
+        if key == 'positions':
+            queries = pd.MultiIndex.from_tuples([(int(pos), str(ref), str(alt)) for pos, ref, alt in values],
+                                                names=index.names) if len(values) else index[:0]
+        else:
+            queries = pd.Index([str(value) for value in values])
+        found = index.get_indexer(queries)
+        return np.where(found >= 0, positions[np.maximum(found, 0)], -1)
+
+
+def iter_lookup_json(df, queries, rows, columns=LOOKUP_COLUMNS, chunk_rows=LOOKUP_CHUNK_ROWS):
+    """
+    Yield the JSON text {"results": [...], "found": n, "missing": n}, one chunk of queries at a time. Every result holds
+    the query, whether it was found and the columns of its variant (null when missing).
+    """
+    yield '{"results": ['
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        found = chunk >= 0
+        values = df.iloc[np.maximum(chunk, 0)][columns].astype(object).reset_index(drop=True)
+        values = values.where(np.repeat(found[:, None], len(columns), axis=1))
+        values.insert(0, 'found', found)
+        values.insert(0, 'query', pd.Series(queries[start:start + chunk_rows], dtype=object))
+        yield (',' if start else '') + values.to_json(orient='records', double_precision=6)[1:-1]
+    n_found = int((rows >= 0).sum())
+    yield '], "found": %d, "missing": %d}' % (n_found, len(rows) - n_found)
+
+
+def parse_lookup_request(body):
+    """(key, values) of a lookup request body, raise ValueError if it does not hold exactly one list of LOOKUP_KEYS"""
+    if not isinstance(body, dict):
+        raise ValueError('The body must be a JSON object')
+    keys = [key for key in LOOKUP_KEYS if key in body]
+    if len(keys) != 1 or not isinstance(body[keys[0]], list):
+        raise ValueError('The body must hold one list among: ' + ', '.join(LOOKUP_KEYS))
+    values = body[keys[0]]
+    if keys[0] == 'positions':
+        try:
+            values = [[int(v['hg38_pos']), v['ref'], v['alt']] if isinstance(v, dict) else [int(v[0]), v[1], v[2]]
+                      for v in values if isinstance(v, dict) or len(v) == 3]
+        except (KeyError, TypeError, ValueError):
+            values = []
+        if len(values) != len(body['positions']):
+            raise ValueError('A position is [hg38_pos, ref, alt] or {"hg38_pos": ..., "ref": ..., "alt": ...}')
+    return keys[0], values
+
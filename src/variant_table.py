@@ -0,0 +1,59 @@
+"""
+    Typed, compact in-memory schema of the variant table (vhl_preprocess_df.csv)
+    - categoricals for the low-cardinality annotations, so the equality filters of the figure callbacks compare codes
+    - float32 for the scores, int32 for the positions and a nullable Int16 protein position (non-coding variants)
+    variant_id and cHGVS are unique per variant and stay plain strings.
+
+    Memory report of the schema :  python variant_table.py [path or url of the csv]
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+CATEGORY_COLUMNS = ['chr', 'ref', 'alt', 'nAA', 'sge_region', 'pHGVS', 'tier_class', 'consequence', 'clinvar_simple',
+                    'Cancer_type_single']
+FLOAT32_COLUMNS = ['function_score_final', 'q_value', 'rna_score', 'rna_score_day_20', 'delta_rna', 'VARITY_R', 'REVEL',
+                   'CADD.phred', 'max_spliceAI', 'alt_pos', 'ref_pos', 'average_fs_missense_at_aa',
+                   'average_fs_missense_at_aa_rna', 'average_fs_at_aa']
+INTEGER_COLUMNS = {'hg38_pos': 'int32', 'index': 'int32', 'protPos': 'Int16'}
+
+
+def read_variant_table(path):
+    """Read the variant table as stored in the csv, with pandas default dtypes"""
+    df = pd.read_csv(path, index_col=0).reset_index(drop=True)
+    df['pHGVS'] = df['pHGVS'].fillna('N/A')
+    df['consequence'] = df['consequence'].replace('Non synonymous', 'Missense')
+    return df
+
+
+def apply_schema(df):
+    """Return a copy of the table with the compact dtypes, columns absent from df are skipped"""
+    dtypes = {column: 'category' for column in CATEGORY_COLUMNS}
+    dtypes.update({column: np.float32 for column in FLOAT32_COLUMNS})
+    dtypes.update(INTEGER_COLUMNS)
+    return df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+
+
+def load_variant_table(path):
+    return apply_schema(read_variant_table(path))
+
+
+def memory_report(before, after):
+    """Text table of the deep memory usage per column of the table before and after the schema"""
+    before_usage, after_usage = before.memory_usage(deep=True), after.memory_usage(deep=True)
+    lines = ['%-32s %-10s %-10s %10s %10s' % ('column', 'before', 'after', 'before kB', 'after kB')]
+    for column in before_usage.index:
+        lines.append('%-32s %-10s %-10s %10.1f %10.1f' % (
+            column, before[column].dtype if column in before else '', after[column].dtype if column in after else '',
+            before_usage[column] / 1024, after_usage.get(column, 0) / 1024))
+    lines.append('%-32s %-10s %-10s %10.1f %10.1f' % ('total', '', '', before_usage.sum() / 1024,
+                                                      after_usage.sum() / 1024))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    table_path = sys.argv[1] if len(sys.argv) > 1 else 'assets/input/vhl_preprocess_df.csv'
+    raw_df = read_variant_table(table_path)
+    print(memory_report(raw_df, apply_schema(raw_df)))
@@ -0,0 +1,133 @@
+"""
+    Streaming annotation of an uploaded VCF with the SGE scores
+    The upload (base64 data URL of dcc.Upload, plain or gzip/bgzip compressed) is decoded, decompressed and split into
+    lines chunk by chunk, records are matched to the variant table in batches through the variant_id hash index
+    (chr_pos_ref_alt, see variant_lookup.py) and the annotated VCF is written to a file as it goes: memory stays bounded
+    by the size of a chunk, whatever the number of records.
+"""
+
+import base64
+import zlib
+
+import numpy as np
+
+VCF_CHUNK_RECORDS = 10000
+BASE64_CHUNK_CHARS = 1 << 20  # multiple of 4
+# INFO fields added to the records with an assayed allele, one value per ALT allele ('.' for the others)
+VCF_INFO_FIELDS = [('SGE_FS', 'function_score_final', 'Float', 'SGE function score'),
+                   ('SGE_CLASS', 'tier_class', 'String', 'SGE function class'),
+                   ('SGE_RNA', 'rna_score', 'Float', 'SGE RNA score'),
+                   ('SGE_Q', 'q_value', 'Float', 'q value of the SGE function score')]
+
+
+def iter_upload_bytes(contents):
+    """
+    Decoded bytes of a dcc.Upload data URL ('data:<type>;base64,<data>'), decompressed if gzip, chunk by chunk.
+    Raise ValueError if the data is not valid base64 or gzip.
+    """
+    start = contents.index(',') + 1 if contents.startswith('data:') else 0
+    decompressor = None
+    for offset in range(start, len(contents), BASE64_CHUNK_CHARS):
+        data = base64.b64decode(contents[offset:offset + BASE64_CHUNK_CHARS], validate=True)
+        if decompressor is None and offset == start and data[:2] == b'\x1f\x8b':
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        if decompressor is None:
+            yield data
+            continue
+        while data:
+            try:
+                yield decompressor.decompress(data)
+            except zlib.error as error:
+                raise ValueError('Invalid gzip data: %s' % error)
+            # bgzip files are a series of gzip members
+            data = decompressor.unused_data
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                data = b''
+
+
+def iter_lines(chunks):
+    """Text lines (without end of line) of a stream of bytes chunks"""
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r').decode('utf-8', errors='replace')
+    if rest:
+        yield rest.rstrip(b'\r').decode('utf-8', errors='replace')
+
+
+def _format_value(value):
+    if value is None or value != value:
+        return '.'
+    if isinstance(value, (float, np.floating)):
+        return '%.4g' % value
+    return str(value).replace(' ', '_').replace(';', ',')
+
+
+class VcfAnnotator:
+    """
+    Annotate the records of a VCF with the scores of the variant table
+    @param lookup
+    VariantLookup of the variant table, the records are matched on its 'variant_ids' index
+    """
+
+    def __init__(self, df, lookup, chunk_records=VCF_CHUNK_RECORDS):
+        self.df = df
+        self.lookup = lookup
+        self.chunk_records = chunk_records
+        self.records = 0
+        self.alleles = 0
+        self.matched_rows = set()
+        self.values = {key: df[column].to_numpy(dtype=object) for key, column, _, _ in VCF_INFO_FIELDS}
+
+    def _annotate_chunk(self, records):
+        """Annotated lines of a batch of records, split into their fields"""
+        ids = []
+        for fields in records:
+            chrom = fields[0][3:] if fields[0].lower().startswith('chr') else fields[0]
+            ids += ['%s_%s_%s_%s' % (chrom, fields[1], fields[3], alt) for alt in fields[4].split(',')]
+        rows = self.lookup.rows('variant_ids', ids)
+        found = rows >= 0
+        self.alleles += len(ids)
+        self.matched_rows.update(rows[found].tolist())
+        values = {key: np.where(found, self.values[key][np.maximum(rows, 0)], None) for key in self.values}
+        lines, allele = [], 0
+        for fields in records:
+            n_alts = fields[4].count(',') + 1
+            if found[allele:allele + n_alts].any():
+                info = ';'.join('%s=%s' % (key, ','.join(_format_value(v) for v in values[key][allele:allele + n_alts]))
+                                for key, _, _, _ in VCF_INFO_FIELDS)
+                fields[7] = info if fields[7] in ('', '.') else fields[7] + ';' + info
+            allele += n_alts
+            lines.append('\t'.join(fields) + '\n')
+        return lines
+
+    def annotate(self, lines, out):
+        """Write the annotated VCF of an iterable of lines to the text file out"""
+        records = []
+        for line in lines:
+            if line.startswith('#'):
+                if line.startswith('#CHROM'):
+                    for key, _, value_type, description in VCF_INFO_FIELDS:
+                        out.write('##INFO=<ID=%s,Number=A,Type=%s,Description="%s">\n' % (key, value_type,
+                                                                                         description))
+                out.write(line + '\n')
+                continue
+            fields = line.split('\t')
+            if len(fields) < 8:
+                continue
+            records.append(fields)
+            self.records += 1
+            if len(records) == self.chunk_records:
+                out.writelines(self._annotate_chunk(records))
+                records = []
+        if records:
+            out.writelines(self._annotate_chunk(records))
+        return self
+
+    @property
+    def matched_variant_ids(self):
+        return self.df['variant_id'].iloc[sorted(self.matched_rows)].tolist()
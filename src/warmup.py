@@ -0,0 +1,97 @@
+"""
+    Boot-time cache warm-up
+    Runs the cached figure builders of the app on the most common input combinations before the server takes traffic,
+    so that the first users do not pay for the structure parsing and the default figures.
+    With gunicorn --preload the warm-up runs once in the master process and the warmed caches are shared
+    copy-on-write by the workers.
+
+    VHL_WARMUP=1 (default) warms up at import, before the server is bound
+    VHL_WARMUP=background warms up in a thread of each process, started by its first request (threads do not survive
+    the fork of the gunicorn workers, a thread started at import would only run in the --preload master), /ready
+    answers 503 until it is done
+    VHL_WARMUP=0 disables the warm-up
+"""
+
+import os
+import threading
+import time
+import traceback
+
+from flask import jsonify
+
+WARMUP_MODE = os.environ.get('VHL_WARMUP', '1')
+
+
+class WarmupState:
+    """Progress of the warm-up, reported by the readiness endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        self.started = None
+        self.seconds = None
+        self.done = 0
+        self.total = 0
+        self.errors = []
+        self.background_tasks = None
+        self.pid = None
+
+    def report(self):
+        with self.lock:
+            return {'ready': self.ready, 'pid': os.getpid(), 'tasks': self.total, 'done': self.done,
+                    'seconds': self.seconds, 'errors': list(self.errors)}
+
+    def start_background(self):
+        """Start the background warm-up of this process, once"""
+        with self.lock:
+            if self.background_tasks is None or self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=run_warmup, args=(self, self.background_tasks), name='vhl-warmup', daemon=True).start()
+
+
+def run_warmup(state, tasks):
+    """
+    Call every (name, function) of tasks, recording progress and failures in state.
+    A failing task is reported but does not prevent the server from becoming ready: its cache is filled on first use.
+    """
+    with state.lock:
+        state.started, state.total, state.done = time.perf_counter(), len(tasks), 0
+    for name, task in tasks:
+        try:
+            task()
+        except Exception:
+            with state.lock:
+                state.errors.append({'task': name, 'error': traceback.format_exc(limit=2)})
+        with state.lock:
+            state.done += 1
+    with state.lock:
+        state.seconds = round(time.perf_counter() - state.started, 3)
+        state.ready = True
+    return state
+
+
+def start_warmup(state, tasks, mode=WARMUP_MODE):
+    if mode == '0':
+        with state.lock:
+            state.ready = True
+        return
+    if mode == 'background':
+        # started by the first request of each process, see install_readiness_endpoint
+        state.background_tasks = tasks
+        return
+    run_warmup(state, tasks)
+
+
+def install_readiness_endpoint(server, state, path='/ready'):
+    """
+    GET path answers 200 once the warm-up is done and 503 before, with the progress as JSON.
+    Every request starts the background warm-up of its process if it has not started yet.
+    """
+
+    def ready():
+        report = state.report()
+        return jsonify(report), 200 if report['ready'] else 503
+
+    server.add_url_rule(path, 'vhl_ready', ready)
+    server.before_request(state.start_background)